@@ -1,19 +1,251 @@
 import logging
 import io
-from typing import Optional, Generator, Tuple, List, Union, Dict, Any
-from PIL import Image
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from typing import Optional, Generator, Tuple, List, Union, Dict, Any, Callable
+from PIL import Image, features
 import json
+import re
+from types import MappingProxyType
 
 try:
     from google import genai
-    from google.genai import types
+    from google.genai import types, errors
     HAS_GENAI = True
 except ImportError:
     HAS_GENAI = False
     logging.error("Google GenAI library not found. Please install 'google-genai'.")
 
+if HAS_GENAI:
+    # Immutable parts of every generation request, built once
+    _SAFETY_SETTINGS = (
+        types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_ONLY_HIGH"),
+        types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_ONLY_HIGH"),
+        types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_ONLY_HIGH"),
+        types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_ONLY_HIGH"),
+    )
+    _BASE_CONFIG = MappingProxyType({
+        "safety_settings": _SAFETY_SETTINGS,
+        "temperature": 1.0, # Recommended for Gemini 3
+    })
+
+# Number of encoded reference images kept across turns
+PART_CACHE_SIZE = 16
+JPEG_QUALITY = 85 # Default; overridable per client (settings key "upload_jpeg_quality")
+UPLOAD_MAX_DIMENSION = 1536 # Default; overridable per client (settings key "upload_max_dim")
+HAS_WEBP = features.check("webp")
+# Chat history is re-sent on every turn: keep it bounded and its images small
+MAX_HISTORY_TURNS = 8 # Default; overridable per client (settings key "history_limit", in messages)
+HISTORY_MAX_DIMENSION = 768
+# Batch variations share one server-side cache of the history instead of re-uploading it
+HISTORY_CACHE_TTL = "300s"
+
+# Completed "concept" string inside a partially streamed Magic Prompt JSON
+_CONCEPT_RE = re.compile(r'"concept"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def _has_transparency(img: Image.Image) -> bool:
+    """True if the image has an alpha channel that is not fully opaque."""
+    if img.mode in ("RGBA", "LA"):
+        return img.getchannel("A").getextrema()[0] < 255
+    if img.mode == "P" and "transparency" in img.info:
+        return img.convert("RGBA").getchannel("A").getextrema()[0] < 255
+    return False
+
+class _GrowableBuf(io.RawIOBase):
+    """
+    Write-only sink over a reusable bytearray. Rewinding keeps the allocation, and
+    writes overwrite in place (growing only past the end), so a thread's encodes
+    settle into one buffer instead of BytesIO's realloc chain.
+    """
+    def __init__(self, size_hint: int = 0):
+        self.buf = bytearray(size_hint)
+        self.pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        n = len(b)
+        end = self.pos + n
+        self.buf[self.pos:end] = b # past the end this extends the array
+        self.pos = end
+        return n
+
+    def tell(self) -> int:
+        return self.pos
+
+    def rewind(self, size_hint: int = 0) -> None:
+        self.pos = 0
+        if len(self.buf) < size_hint:
+            self.buf.extend(bytes(size_hint - len(self.buf)))
+
+    def getvalue(self) -> bytes:
+        """Bytes written since the last rewind (the tail may hold stale data)."""
+        with memoryview(self.buf) as view:
+            return bytes(view[:self.pos])
+
+def _downscale(img: Image.Image, max_dim: int) -> Image.Image:
+    """Returns a copy of img that fits within max_dim (or img itself if it already fits)."""
+    if img.width <= max_dim and img.height <= max_dim: return img
+    small = img.copy()
+    small.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+    return small
+
+def _stream_error_text(e: Exception) -> str:
+    """User-facing message for a failed stream, dispatched on the SDK's typed errors."""
+    if isinstance(e, errors.ServerError):
+        if e.code == 503:
+            return "\n[System: Google AI Model is overloaded (503). Please wait a moment and try again.]"
+        return f"\n[System: Server Error ({e.code}) - {e.message}]"
+    if isinstance(e, errors.ClientError):
+        return f"\n[System: Request rejected ({e.code}) - {e.message}]"
+    return f"\n[System: Network Error - {e}]"
+
+def _cache_error_kind(e: Exception) -> str:
+    """
+    Why caches.create failed: "unsupported" (the model has no explicit caching),
+    "too_small" (history under the model's minimum token count) or "other".
+    """
+    if isinstance(e, errors.ClientError):
+        msg = (e.message or "").lower()
+        if "too small" in msg or "min_total_token_count" in msg: return "too_small"
+        if e.code == 404 or "not supported" in msg: return "unsupported"
+    return "other"
+
+# --- Magic Prompt (enhance_prompt) ---
+
+# Modern reasoning model
+ENHANCE_MODEL = "gemini-3-pro-preview"
+
+# Full Schema definition (UniversalImagePrompt)
+_ENHANCE_SCHEMA = {
+    "type": "object",
+    "title": "UniversalImagePrompt",
+    "description": "A structured, model-agnostic prompt description for text-to-image generation.",
+    "properties": {
+        "concept": {
+            "type": "string",
+            "description": "Very short summary of the main idea (1 short phrase)."
+        },
+        "scene": {
+            "type": "object",
+            "description": "What is happening, where, and with what key elements.",
+            "properties": {
+                "setting": {
+                    "type": "string",
+                    "description": "Environment or location (city street, forest, spaceship bridge, fantasy castle hall, abstract void, etc.)."
+                },
+                "time_of_day": {
+                    "type": "string",
+                    "description": "Time and ambience: dawn, golden hour, night, neon-lit, overcast, etc."
+                },
+                "key_elements": {
+                    "type": "array",
+                    "description": "Important objects, characters, creatures, or landmarks that must appear.",
+                    "items": {
+                        "type": "string"
+                    }
+                },
+                "action": {
+                    "type": "string",
+                    "description": "Short description of what is happening in the scene. Leave empty if static."
+                }
+            }
+        },
+        "style": {
+            "type": "object",
+            "description": "Visual style and mood.",
+            "properties": {
+                "mood_keywords": {
+                    "type": "array",
+                    "description": "Mood/adjectives: dreamy, dark, epic, cozy, surreal, cyberpunk, whimsical, etc.",
+                    "items": {
+                        "type": "string"
+                    }
+                },
+                "art_style": {
+                    "type": "string",
+                    "description": "Overall style: photorealistic, cinematic, digital painting, anime, pixel art, lowpoly, oil painting, concept art, etc."
+                },
+                "color_palette": {
+                    "type": "string",
+                    "description": "Dominant colors/palette: warm oranges and reds, cold blues, neon, pastel, monochrome, etc."
+                },
+                "influences": {
+                    "type": "array",
+                    "description": "Optional references: 'Studio Ghibli-like', 'dark fantasy', 'sci-fi concept art', etc. No direct copyrighted names if avoidable.",
+                    "items": {
+                        "type": "string"
+                    }
+                }
+            }
+        },
+        "composition": {
+            "type": "object",
+            "description": "How the image is framed and composed.",
+            "properties": {
+                "framing": {
+                    "type": "string",
+                    "description": "Wide shot, mid shot, close-up, top-down, isometric, etc."
+                },
+                "focus": {
+                    "type": "string",
+                    "description": "What should be in focus or emphasized."
+                },
+                "depth_of_field": {
+                    "type": "string",
+                    "description": "Shallow DOF with blurred background, deep focus, etc."
+                },
+                "additional_notes": {
+                    "type": "string",
+                    "description": "Extra composition hints: symmetry, rule of thirds, leading lines, minimalism, cluttered detail, etc."
+                }
+            }
+        },
+        "technical": {
+            "type": "object",
+            "description": "Technical preferences that are model-agnostic.",
+            "properties": {
+                "render_quality": {
+                    "type": "string",
+                    "description": "Overall quality: high detail, ultra-detailed, painterly, sketchy, etc."
+                },
+                "aspect_ratio_hint": {
+                    "type": "string",
+                    "description": "Desired aspect ratio or orientation, e.g. '3:4 vertical', '16:9 wide', '1:1 square'. This is a hint, not a command."
+                },
+                "avoid": {
+                    "type": "array",
+                    "description": "What should NOT appear (e.g., 'no text', 'no watermark', 'no frame', etc.).",
+                    "items": {
+                        "type": "string"
+                    }
+                }
+            }
+        },
+        "final_prompt": {
+            "type": "string",
+            "description": "Single coherent English description combining all important details from this JSON, ready to be used as a text prompt. No JSON/meta references."
+        }
+    },
+    "required": [
+        "concept",
+        "final_prompt"
+    ]
+}
+
+_ENHANCE_SYSTEM_INSTRUCTION = (
+    "You are an expert prompt engineer for generative AI. "
+    "Your task is to convert a user's raw input (and optional reference image) into a structured "
+    "image generation prompt using the provided JSON schema. "
+    "The downstream model is optimized to understand this specific JSON structure directly. "
+    "Do NOT simplify or summarize. Fill all relevant fields based on the input and your creative inference."
+)
+
 class GeminiClient:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, jpeg_quality: int = JPEG_QUALITY, upload_max_dim: int = UPLOAD_MAX_DIMENSION,
+                 history_limit: int = MAX_HISTORY_TURNS * 2):
         if not HAS_GENAI:
             raise ImportError("Library 'google-genai' not installed.")
         
@@ -21,7 +253,21 @@ class GeminiClient:
             logging.warning("GeminiClient initialized without API Key")
         
         self.client = genai.Client(api_key=api_key)
-        self.history: List[types.Content] = []
+        # Oldest turns age out on append; an even bound keeps user/model pairs aligned
+        self.history: "deque[types.Content]" = deque(maxlen=max(2, history_limit - history_limit % 2))
+        self._part_cache: "OrderedDict[bytes, types.Part]" = OrderedDict()
+        self._part_lock = threading.Lock() # variations encode concurrently
+        self._enhance_config: Optional[types.GenerateContentConfig] = None
+        self._encode_local = threading.local() # per-thread reusable encode buffer
+        self.jpeg_quality = jpeg_quality
+        self.upload_max_dim = upload_max_dim
+        # (history generation, model, cache name) for the current history; "" = creation failed
+        self._history_cache: Optional[Tuple[int, str, str]] = None
+        self._history_gen = 0 # bumped whenever the history changes
+        self._uncacheable: set = set() # models without explicit caching: always sent inline
+        self._cache_too_small: Dict[str, int] = {} # model -> longest history rejected as too small
+        self._cache_lock = threading.Lock() # guards the fields above; never held across network calls
+        self._create_lock = threading.Lock() # one upload per batch; only worker threads take it
         
         self.system_instruction = (
             "You are an expert digital art assistant integrated into Krita. "
@@ -29,15 +275,61 @@ class GeminiClient:
         )
         logging.info("Gemini API client initialized (v2 SDK)")
 
+    def _encode_buffer(self, size_hint: int = 0) -> _GrowableBuf:
+        """Returns this thread's scratch buffer, rewound for a new encode."""
+        buf = getattr(self._encode_local, "buf", None)
+        if buf is None:
+            buf = self._encode_local.buf = _GrowableBuf(size_hint)
+        buf.rewind(size_hint)
+        return buf
+
     def _image_to_part(self, img: Image.Image) -> types.Part:
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return types.Part(
+        # The same canvas is usually re-sent for many turns in a row.
+        # Key on pixel content so each unique image is encoded only once.
+        digest = hashlib.blake2b(img.tobytes(), digest_size=16)
+        digest.update(f"{img.mode}{img.size}".encode())
+        key = digest.digest()
+        
+        with self._part_lock:
+            part = self._part_cache.get(key)
+            if part is not None:
+                self._part_cache.move_to_end(key)
+                return part
+        
+        # Whatever the caller passes, never encode/upload more than the model can use
+        img = _downscale(img, self.upload_max_dim)
+        
+        # Compressed output rarely exceeds ~half a byte per pixel
+        buf = self._encode_buffer(img.width * img.height // 2)
+        if _has_transparency(img):
+            # Alpha matters: keep it lossless
+            rgba = img if img.mode == "RGBA" else img.convert("RGBA")
+            if HAS_WEBP:
+                # quality/method are effort knobs in lossless mode: fastest, ~PNG-sized
+                rgba.save(buf, format="WEBP", lossless=True, quality=0, method=0)
+                mime_type = "image/webp"
+            else:
+                rgba.save(buf, format="PNG", compress_level=1)
+                mime_type = "image/png"
+        else:
+            # Opaque canvas: JPEG is far smaller and faster to encode than PNG
+            rgb = img if img.mode in ("RGB", "L") else img.convert("RGB")
+            rgb.save(buf, format="JPEG", quality=self.jpeg_quality, optimize=False, progressive=False)
+            mime_type = "image/jpeg"
+        
+        data = buf.getvalue()
+        
+        part = types.Part(
             inline_data=types.Blob(
-                mime_type="image/png",
-                data=buf.getvalue()
+                mime_type=mime_type,
+                data=data
             )
         )
+        with self._part_lock:
+            self._part_cache[key] = part
+            if len(self._part_cache) > PART_CACHE_SIZE:
+                self._part_cache.popitem(last=False)
+        return part
 
     def _create_user_content(self, prompt_text: str, images: List[Image.Image]) -> types.Content:
         parts = []
@@ -55,36 +347,30 @@ class GeminiClient:
     def _create_model_content(self, response_text: str) -> types.Content:
         return types.Content(role="model", parts=[types.Part(text=response_text)])
 
-    def _get_config(self, seed: int, aspect_ratio: Optional[str], image_size: str = "1K") -> types.GenerateContentConfig:
-        safety_settings = [
-            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_ONLY_HIGH"),
-            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_ONLY_HIGH"),
-            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_ONLY_HIGH"),
-            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_ONLY_HIGH"),
-        ]
-
-        config_args = {
-            "seed": seed,
-            "safety_settings": safety_settings,
-            "temperature": 1.0, # Recommended for Gemini 3
-            "system_instruction": self.system_instruction,
-            "response_modalities": ["TEXT"]
-        }
+    def _get_config(self, seed: int, aspect_ratio: Optional[str], image_size: str = "1K", cached_content: Optional[str] = None) -> types.GenerateContentConfig:
+        config_args = dict(_BASE_CONFIG)
+        config_args["seed"] = seed
+        if cached_content:
+            # The system instruction lives in the cache and must not be repeated
+            config_args["cached_content"] = cached_content
+        else:
+            config_args["system_instruction"] = self.system_instruction
+        config_args["response_modalities"] = ["TEXT", "IMAGE"] if aspect_ratio else ["TEXT"]
 
-        if aspect_ratio:
-            config_args["response_modalities"].append("IMAGE")
-            ar_val = aspect_ratio.split(" ")[0]
-            
-            img_config_args = {"aspect_ratio": ar_val}
+        # aspect_ratio is already canonical "W:H" (see krita_api.get_nearest_supported_ar)
+        if aspect_ratio and ":" in aspect_ratio:
+            img_config_args = {"aspect_ratio": aspect_ratio}
             if image_size and image_size != "1K":
                  img_config_args["image_size"] = image_size
-                 
-            if ":" in ar_val:
-                config_args["image_config"] = types.ImageConfig(**img_config_args)
+            config_args["image_config"] = types.ImageConfig(**img_config_args)
 
         return types.GenerateContentConfig(**config_args)
 
     def _stream_handler(self, stream) -> Generator[Tuple[Optional[str], Optional[Image.Image], Optional[Any]], None, None]:
+        """
+        Yields (text, image, part) per part, as soon as it arrives; the UI coalesces text
+        redraws itself (see NanobananaChatWidget.handle_text).
+        """
         try:
             for chunk in stream:
                 if not chunk.candidates:
@@ -114,29 +400,31 @@ class GeminiClient:
                     if part.inline_data:
                         try:
                             img_data = part.inline_data.data
-                            img_val = Image.open(io.BytesIO(img_data))
+                            # Decode eagerly (once, on this worker thread) and release
+                            # the source buffer instead of handing out a lazy image
+                            with io.BytesIO(img_data) as buf:
+                                img_val = Image.open(buf)
+                                img_val.load()
                         except Exception as e:
                             logging.error(f"Image decode error: {e}")
                             text_val = "[System: Failed to decode image]"
                     
                     # Yield for UI (masked if thought), and raw part for History
-                    yield (None if is_thought else text_val, None if is_thought else img_val, part)
+                    if is_thought:
+                        text_val = img_val = None
+                    yield (text_val, img_val, part)
                             
         except Exception as e:
             logging.error(f"Stream iteration error: {e}")
-            if "503" in str(e) or "overloaded" in str(e).lower():
-                yield ("\n[System: Google AI Model is overloaded (503). Please wait a moment and try again.]", None, None)
-            else:
-                yield (f"\n[System: Network Error - {str(e)}]", None, None)
+            yield (_stream_error_text(e), None, None)
 
     def send_prompt(self, prompt: str, images: List[Image.Image], seed: int, model: str, aspect_ratio: str, image_size: str = "1K") -> Generator[Tuple[Optional[str], Optional[Image.Image]], None, None]:
         user_content = self._create_user_content(prompt, images)
-        request_history = self.history + [user_content]
+        request_history = [*self.history, user_content]
         
         config = self._get_config(seed, aspect_ratio, image_size)
         logging.info(f"Sending Prompt. History: {len(self.history)} turns.")
 
-        full_text = ""
         collected_parts = []
         
         try:
@@ -147,28 +435,101 @@ class GeminiClient:
             )
             
             for text, img, part in self._stream_handler(stream):
-                if text: full_text += text
                 if part: collected_parts.append(part)
                 yield (text, img)
             
             if collected_parts:
                 # Reconstruct content from ALL parts to preserve Thought Signatures (Gemini 3)
                 model_content = types.Content(role="model", parts=collected_parts)
+                
+                # Later turns only need a smaller copy of this turn's references
+                if images:
+                    small = [_downscale(img, HISTORY_MAX_DIMENSION) for img in images]
+                    user_content = self._create_user_content(prompt, small)
                 self.history.append(user_content)
-                self.history.append(model_content)
+                self.history.append(model_content) # maxlen drops the oldest pair
+                self._invalidate_history_cache()
                 
         except Exception as e:
             logging.error(f"Generation Failed: {e}")
             yield (f"[System: Setup Error - {str(e)}]", None)
 
+    def _history_cache_name(self, model: str) -> Optional[str]:
+        """
+        Name of an explicit cache holding the current history (created on first use),
+        or None to send the history inline. Failures are remembered by cause so a
+        batch never pays a doomed upload: models without caching are skipped for the
+        session, histories under the minimum size until the history has grown, and
+        anything else until the history changes.
+        """
+        if not self.history or model in self._uncacheable: return None
+        if len(self.history) <= self._cache_too_small.get(model, 0): return None
+        # Held across the upload on purpose: the other variations of a batch would
+        # otherwise each upload the same history. Only worker threads take this lock;
+        # the GUI thread (Undo/Reset) only ever takes the short-held _cache_lock.
+        with self._create_lock:
+            with self._cache_lock:
+                gen = self._history_gen
+                if self._history_cache and self._history_cache[:2] == (gen, model):
+                    return self._history_cache[2] or None
+                contents = list(self.history)
+            try:
+                cache = self.client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                    contents=contents,
+                    system_instruction=self.system_instruction,
+                    ttl=HISTORY_CACHE_TTL
+                ))
+            except Exception as e:
+                kind = _cache_error_kind(e)
+                logging.info(f"History cache unavailable for {model} ({kind}), sending inline: {e}")
+                with self._cache_lock:
+                    if kind == "unsupported":
+                        self._uncacheable.add(model)
+                    elif kind == "too_small":
+                        self._cache_too_small[model] = len(contents)
+                    elif self._history_gen == gen:
+                        self._history_cache = (gen, model, "")
+                return None
+            with self._cache_lock:
+                current = self._history_gen == gen
+                if current:
+                    stale = self._history_cache[2] if self._history_cache else "" # other model's cache
+                    self._history_cache = (gen, model, cache.name)
+            if not current:
+                self._delete_cache(cache.name) # history changed during the upload
+                return None
+            self._delete_cache(stale)
+            return cache.name
+
+    def _invalidate_history_cache(self) -> None:
+        """History changed: the next variation needs a new cache; the old one is deleted."""
+        with self._cache_lock:
+            self._history_gen += 1
+            old = self._history_cache[2] if self._history_cache else ""
+            self._history_cache = None
+        self._delete_cache(old)
+
+    def _delete_cache(self, name: str) -> None:
+        """Deletes a superseded cache in the background (it is billed until deleted or expired)."""
+        if not name: return
+        def delete():
+            try:
+                self.client.caches.delete(name=name)
+            except Exception as e:
+                logging.info(f"Could not delete history cache {name} (expires by TTL): {e}")
+        # Daemon: called from the GUI thread on Undo/Reset, and must never delay exit
+        threading.Thread(target=delete, name="nanobanana-cache-delete", daemon=True).start()
+
     def generate_variation(self, prompt: str, images: List[Image.Image], seed: int, model: str, aspect_ratio: str, image_size: str = "1K") -> Generator[Tuple[Optional[str], Optional[Image.Image]], None, None]:
         user_content = self._create_user_content(prompt, images)
-        request_history = self.history + [user_content]
-        
-        config = self._get_config(seed, aspect_ratio, image_size)
         logging.info(f"Generating Variation. Seed: {seed}")
 
         try:
+            # Only the new turn travels with the request when the history is cached
+            cache_name = self._history_cache_name(model)
+            request_history = [user_content] if cache_name else [*self.history, user_content]
+            config = self._get_config(seed, aspect_ratio, image_size, cached_content=cache_name)
+            
             stream = self.client.models.generate_content_stream(
                 model=model,
                 contents=request_history,
@@ -180,139 +541,14 @@ class GeminiClient:
             logging.error(f"Variation Failed: {e}")
             yield (f"[System: Variation Error - {str(e)}]", None)
 
-    def enhance_prompt(self, user_prompt: str, images: List[Image.Image]) -> Dict[str, Any]:
+    def enhance_prompt(self, user_prompt: str, images: List[Image.Image], on_concept: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
         """
         Generates a structured, professional prompt based on user text and optional reference images.
         Uses gemini-3-pro-preview (or newer) and structured JSON output.
-        """
-        # Use modern reasoning model
-        reasoning_model = "gemini-3-pro-preview" 
-        
-        # Full Schema definition (UniversalImagePrompt)
-        schema = {
-            "type": "object",
-            "title": "UniversalImagePrompt",
-            "description": "A structured, model-agnostic prompt description for text-to-image generation.",
-            "properties": {
-                "concept": {
-                    "type": "string",
-                    "description": "Very short summary of the main idea (1 short phrase)."
-                },
-                "scene": {
-                    "type": "object",
-                    "description": "What is happening, where, and with what key elements.",
-                    "properties": {
-                        "setting": {
-                            "type": "string",
-                            "description": "Environment or location (city street, forest, spaceship bridge, fantasy castle hall, abstract void, etc.)."
-                        },
-                        "time_of_day": {
-                            "type": "string",
-                            "description": "Time and ambience: dawn, golden hour, night, neon-lit, overcast, etc."
-                        },
-                        "key_elements": {
-                            "type": "array",
-                            "description": "Important objects, characters, creatures, or landmarks that must appear.",
-                            "items": {
-                                "type": "string"
-                            }
-                        },
-                        "action": {
-                            "type": "string",
-                            "description": "Short description of what is happening in the scene. Leave empty if static."
-                        }
-                    }
-                },
-                "style": {
-                    "type": "object",
-                    "description": "Visual style and mood.",
-                    "properties": {
-                        "mood_keywords": {
-                            "type": "array",
-                            "description": "Mood/adjectives: dreamy, dark, epic, cozy, surreal, cyberpunk, whimsical, etc.",
-                            "items": {
-                                "type": "string"
-                            }
-                        },
-                        "art_style": {
-                            "type": "string",
-                            "description": "Overall style: photorealistic, cinematic, digital painting, anime, pixel art, lowpoly, oil painting, concept art, etc."
-                        },
-                        "color_palette": {
-                            "type": "string",
-                            "description": "Dominant colors/palette: warm oranges and reds, cold blues, neon, pastel, monochrome, etc."
-                        },
-                        "influences": {
-                            "type": "array",
-                            "description": "Optional references: 'Studio Ghibli-like', 'dark fantasy', 'sci-fi concept art', etc. No direct copyrighted names if avoidable.",
-                            "items": {
-                                "type": "string"
-                            }
-                        }
-                    }
-                },
-                "composition": {
-                    "type": "object",
-                    "description": "How the image is framed and composed.",
-                    "properties": {
-                        "framing": {
-                            "type": "string",
-                            "description": "Wide shot, mid shot, close-up, top-down, isometric, etc."
-                        },
-                        "focus": {
-                            "type": "string",
-                            "description": "What should be in focus or emphasized."
-                        },
-                        "depth_of_field": {
-                            "type": "string",
-                            "description": "Shallow DOF with blurred background, deep focus, etc."
-                        },
-                        "additional_notes": {
-                            "type": "string",
-                            "description": "Extra composition hints: symmetry, rule of thirds, leading lines, minimalism, cluttered detail, etc."
-                        }
-                    }
-                },
-                "technical": {
-                    "type": "object",
-                    "description": "Technical preferences that are model-agnostic.",
-                    "properties": {
-                        "render_quality": {
-                            "type": "string",
-                            "description": "Overall quality: high detail, ultra-detailed, painterly, sketchy, etc."
-                        },
-                        "aspect_ratio_hint": {
-                            "type": "string",
-                            "description": "Desired aspect ratio or orientation, e.g. '3:4 vertical', '16:9 wide', '1:1 square'. This is a hint, not a command."
-                        },
-                        "avoid": {
-                            "type": "array",
-                            "description": "What should NOT appear (e.g., 'no text', 'no watermark', 'no frame', etc.).",
-                            "items": {
-                                "type": "string"
-                            }
-                        }
-                    }
-                },
-                "final_prompt": {
-                    "type": "string",
-                    "description": "Single coherent English description combining all important details from this JSON, ready to be used as a text prompt. No JSON/meta references."
-                }
-            },
-            "required": [
-                "concept",
-                "final_prompt"
-            ]
-        }
-
-        system_instr = (
-            "You are an expert prompt engineer for generative AI. "
-            "Your task is to convert a user's raw input (and optional reference image) into a structured "
-            "image generation prompt using the provided JSON schema. "
-            "The downstream model is optimized to understand this specific JSON structure directly. "
-            "Do NOT simplify or summarize. Fill all relevant fields based on the input and your creative inference."
-        )
         
+        The response is streamed; `on_concept` (if given) is called as soon as the
+        "concept" field has arrived, long before the full JSON is complete.
+        """
         parts = []
         if user_prompt:
             parts.append(types.Part(text=f"User Request: {user_prompt}"))
@@ -325,23 +561,38 @@ class GeminiClient:
 
         content = types.Content(role="user", parts=parts)
         
-        config = types.GenerateContentConfig(
-            system_instruction=system_instr,
-            response_mime_type="application/json",
-            response_schema=schema,
-            temperature=1.0,
-            top_p=0.95
-        )
+        # The config only wraps module constants: build (and validate) it once
+        if self._enhance_config is None:
+            self._enhance_config = types.GenerateContentConfig(
+                system_instruction=_ENHANCE_SYSTEM_INSTRUCTION,
+                response_mime_type="application/json",
+                response_schema=_ENHANCE_SCHEMA,
+                temperature=1.0,
+                top_p=0.95
+            )
 
         try:
-            response = self.client.models.generate_content(
-                model=reasoning_model,
+            stream = self.client.models.generate_content_stream(
+                model=ENHANCE_MODEL,
                 contents=[content],
-                config=config
+                config=self._enhance_config
             )
             
-            if response.text:
-                return json.loads(response.text)
+            chunks: List[str] = []
+            concept = None
+            for chunk in stream:
+                text = chunk.text
+                if not text: continue
+                chunks.append(text)
+                if on_concept and concept is None:
+                    match = _CONCEPT_RE.search("".join(chunks))
+                    if match:
+                        concept = json.loads(f'"{match.group(1)}"')
+                        on_concept(concept)
+            
+            raw = "".join(chunks)
+            if raw:
+                return json.loads(raw)
             return {"final_prompt": "Error: Empty response from Magic Prompt."}
             
         except Exception as e:
@@ -349,11 +600,15 @@ class GeminiClient:
             return {"final_prompt": f"Magic Prompt Error: {str(e)}"}
 
     def undo_last_turn(self) -> bool:
-        if len(self.history) >= 2:
-            self.history.pop()
-            self.history.pop()
-            return True
-        return False
+        if len(self.history) < 2: return False
+        self.history.pop() # model
+        self.history.pop() # user
+        self._invalidate_history_cache()
+        return True
 
     def reset_session(self) -> None:
-        self.history = []
+        self.history.clear() # same deque object, so holders of it see the reset
+        self._invalidate_history_cache()
+        # New session, new references: don't keep old encodes alive
+        with self._part_lock:
+            self._part_cache.clear()
@@ -1,12 +1,47 @@
 from krita import *
+import bisect
+import functools
+import threading
+from concurrent.futures import Executor
 import numpy as np
 from PIL import Image
 import logging
-from PyQt5.QtCore import QByteArray
+from dataclasses import dataclass
+from PyQt5.QtCore import QByteArray, QRect
 from typing import Optional, List, Tuple, Union
 
+try:
+    import cv2
+    HAS_CV2 = True
+except ImportError:
+    HAS_CV2 = False # Optional: faster large downscales (Krita's Python usually lacks it)
+
 MAX_DIMENSION = 1536 
 
+# Official Gemini Image Generation Aspect Ratios & Resolutions
+SUPPORTED_ASPECT_RATIOS = {
+    "1:1": 1.0,
+    "2:3": 0.666,
+    "3:2": 1.500,
+    "3:4": 0.750,
+    "4:3": 1.333,
+    "4:5": 0.800,
+    "5:4": 1.250,
+    "9:16": 0.5625,
+    "16:9": 1.777,
+    "21:9": 2.333
+}
+# Below these sizes the fixed overhead outweighs the pixel work itself
+_SAMPLE_MIN_PIXELS = 256 * 256 # strided pre-check in _is_array_empty
+_SAMPLE_STRIDE = 64 # every 64th row/column: ~1/64 of the rows' memory traffic
+_PARALLEL_MIN_PIXELS = 1024 * 1024 # worker pool in process_capture
+_CV2_MIN_PIXELS = 512 * 512 # cv2.resize in resize_image_maintain_aspect
+
+# Sorted parallel tables for bisect lookup in get_nearest_supported_ar
+_AR_SORTED = sorted((ratio, name) for name, ratio in SUPPORTED_ASPECT_RATIOS.items())
+_AR_RATIOS = tuple(ratio for ratio, _ in _AR_SORTED)
+_AR_NAMES = tuple(name for _, name in _AR_SORTED)
+
 def resize_image_maintain_aspect(image: Image.Image, max_dim: int = MAX_DIMENSION) -> Optional[Image.Image]:
     """
     Downscales image to fit max_dim, maintaining aspect ratio (No Cropping).
@@ -23,26 +58,42 @@ def resize_image_maintain_aspect(image: Image.Image, max_dim: int = MAX_DIMENSIO
     if w <= max_dim and h <= max_dim: return image
     ratio = min(max_dim / w, max_dim / h)
     new_w, new_h = int(w * ratio), int(h * ratio)
+    
+    if HAS_CV2 and w * h > _CV2_MIN_PIXELS and _cv2_resizable(image):
+        # SIMD + multi-threaded area average in one pass
+        out = cv2.resize(np.asarray(image), (new_w, new_h), interpolation=cv2.INTER_AREA)
+        return Image.fromarray(out, image.mode)
+    
+    # Pyramidal downscale: cheap integer box reduction first, then LANCZOS
+    # only for the remaining (< 2x) fractional step.
+    factor = int(1 / ratio)
+    if factor >= 2:
+        image = image.reduce(factor)
     return image.resize((new_w, new_h), Image.Resampling.LANCZOS)
 
+def _cv2_resizable(image: Image.Image) -> bool:
+    """
+    cv2 averages channels independently, so RGBA only qualifies when fully
+    opaque (PIL premultiplies alpha; cv2 would bleed transparent colour in).
+    """
+    if image.mode in ("RGB", "L"): return True
+    return image.mode == "RGBA" and image.getextrema()[3][0] == 255
+
 def _bgra_to_pil(pixel_data: bytes, w: int, h: int) -> Optional[Image.Image]:
     """Converts raw BGRA byte data (from Krita) to an RGBA PIL Image."""
     try:
-        arr = np.frombuffer(pixel_data, dtype=np.uint8)
-        if arr.size != w * h * 4: 
-            logging.error(f"Buffer size mismatch. Expected {w*h*4}, got {arr.size}")
+        if len(pixel_data) != w * h * 4: 
+            logging.error(f"Buffer size mismatch. Expected {w*h*4}, got {len(pixel_data)}")
             return None
         
-        # Reshape to (Height, Width, Channels)
-        arr = arr.reshape((h, w, 4))
-        
-        # Krita uses BGRA, PIL uses RGBA. Swap channels.
-        # arr[:, :, [2, 1, 0, 3]] swaps B and R.
-        return Image.fromarray(arr[:, :, [2, 1, 0, 3]].copy(), 'RGBA')
+        # Krita uses BGRA, PIL uses RGBA. PIL's 'BGRA' raw decoder swaps
+        # channels in C during the single decode pass.
+        return Image.frombuffer('RGBA', (w, h), pixel_data, 'raw', 'BGRA', 0, 1)
     except Exception as e:
         logging.error(f"Conversion error: {e}")
         return None
 
+@functools.lru_cache(maxsize=1024) # pure; the same canvas/selection size repeats every send
 def get_nearest_supported_ar(width: int, height: int) -> str:
     """
     Maps arbitrary canvas dimensions to the closest Gemini-supported Aspect Ratio.
@@ -53,46 +104,46 @@ def get_nearest_supported_ar(width: int, height: int) -> str:
     if width == 0 or height == 0: return "1:1"
     target_ratio = width / height
     
-    # Official Gemini Image Generation Aspect Ratios & Resolutions
-    supported_ratios = {
-        "1:1": 1.0,
-        "2:3": 0.666,
-        "3:2": 1.500,
-        "3:4": 0.750,
-        "4:3": 1.333,
-        "4:5": 0.800,
-        "5:4": 1.250,
-        "9:16": 0.5625,
-        "16:9": 1.777,
-        "21:9": 2.333
-    }
-    
-    # Find key with minimum absolute difference
-    best_ar = min(supported_ratios.keys(), key=lambda k: abs(supported_ratios[k] - target_ratio))
+    # Binary search, then pick the closer of the two neighbours
+    i = bisect.bisect_left(_AR_RATIOS, target_ratio)
+    if i == 0:
+        best_ar = _AR_NAMES[0]
+    elif i == len(_AR_RATIOS):
+        best_ar = _AR_NAMES[-1]
+    elif target_ratio - _AR_RATIOS[i - 1] <= _AR_RATIOS[i] - target_ratio:
+        best_ar = _AR_NAMES[i - 1]
+    else:
+        best_ar = _AR_NAMES[i]
             
     logging.debug(f"AR Mapping: {width}x{height} (r={target_ratio:.2f}) -> {best_ar}")
     return best_ar
 
-def get_smart_context() -> Tuple[List[Image.Image], Tuple[int, int, int, int], str, str]:
+@dataclass
+class CanvasCapture:
     """
-    Extracts context for generation based on Krita state with Smart Detection.
+    Raw Krita pixels grabbed on the GUI thread, not yet converted.
+    
+    Krita's API must be called from the main thread, but turning the buffers
+    into PIL images (see process_capture) is pure pixel work that can run on a
+    worker thread.
+    """
+    buffers: List[Tuple[bytes, int, int]] # (BGRA data, width, height)
+    geometry: Tuple[int, int, int, int]
+    desc: str
+    aspect_ratio: str
+    multi_layer: bool = False
+
+def capture_smart_context() -> CanvasCapture:
+    """
+    Grabs the raw context pixels from Krita. Must run on the GUI thread.
     
     Logic:
     - Hides "Nanobanana Preview" layer to avoid feedback loops.
-    - Grabs content based on Selection or Full Canvas.
-    - Smart Detect: If content is Empty/White -> Txt2Img (returns empty list).
-    - If content exists -> Img2Img (returns list with image).
-
-    Returns:
-        Tuple containing:
-        - List of PIL Images (empty if Txt2Img, [img] if Img2Img)
-        - Geometry Tuple (x, y, w, h) for placement
-        - Description string (for UI)
-        - Aspect Ratio string (for API)
+    - Grabs selected layers (2+), or content based on Selection or Full Canvas.
     """
     doc = Krita.instance().activeDocument()
     if not doc: 
-        return ([], (0,0,0,0), "No Doc", "1:1")
+        return CanvasCapture([], (0,0,0,0), "No Doc", "1:1")
 
     # 1. Check for Multi-Layer override (Composition)
     window = Krita.instance().activeWindow()
@@ -102,18 +153,16 @@ def get_smart_context() -> Tuple[List[Image.Image], Tuple[int, int, int, int], s
         
         if len(valid_nodes) > 1:
             logging.info(f"Context: {len(valid_nodes)} Selected Layers")
-            images = []
+            buffers = []
             for node in valid_nodes:
                 if node.name() == "Nanobanana Preview": continue # Skip preview
                 b = node.bounds()
                 if b.isEmpty(): continue
                 d = node.pixelData(b.x(), b.y(), b.width(), b.height())
-                i = _bgra_to_pil(d, b.width(), b.height())
-                if i and not _is_image_empty(i): 
-                    images.append(resize_image_maintain_aspect(i))
+                buffers.append((d, b.width(), b.height()))
             
             canvas_ar = get_nearest_supported_ar(doc.width(), doc.height())
-            return (images, (0, 0, doc.width(), doc.height()), f"{len(images)} Layers (Smart)", canvas_ar)
+            return CanvasCapture(buffers, (0, 0, doc.width(), doc.height()), "Layers (Smart)", canvas_ar, multi_layer=True)
 
     # 2. Unified Geometry Logic (Selection OR Full Canvas)
     sel = doc.selection()
@@ -128,67 +177,162 @@ def get_smart_context() -> Tuple[List[Image.Image], Tuple[int, int, int, int], s
         desc = "Canvas"
 
     # --- Hide Preview Layer before grabbing context ---
+    # Each refreshProjection is a full-canvas recomposite, so only pay for the
+    # hide/restore round-trip when the preview actually overlaps the region.
     preview_node = doc.nodeByName("Nanobanana Preview")
     was_visible = False
-    if preview_node:
-        was_visible = preview_node.visible()
-        if was_visible:
+    if preview_node and preview_node.visible():
+        if preview_node.bounds().intersects(QRect(x, y, w, h)):
+            was_visible = True
             preview_node.setVisible(False)
             doc.refreshProjection() # Force update to hide it from pixelData
     
-    processed_imgs = []
-    final_desc = desc
-    
     try:
         # 3. Calculate AR & Extract Pixels
         ar_string = get_nearest_supported_ar(w, h)
-        
         data = doc.pixelData(x, y, w, h)
-        img = _bgra_to_pil(data, w, h)
-        
-        if img:
-            if _is_image_empty(img):
-                logging.info("Smart Detect: Canvas/Selection is empty/white -> Mode: Txt2Img")
-                final_desc += " (Empty)"
-            else:
-                logging.info("Smart Detect: Content found -> Mode: Img2Img")
-                processed_imgs.append(resize_image_maintain_aspect(img))
-                final_desc += " (Ref)"
-                
     finally:
         # Restore Preview Layer
         if preview_node and was_visible:
             preview_node.setVisible(True)
             doc.refreshProjection()
         
-    return (processed_imgs, (x, y, w, h), final_desc, ar_string)
+    return CanvasCapture([(data, w, h)], (x, y, w, h), desc, ar_string)
+
+def _process_layer(data: bytes, w: int, h: int) -> Optional[Image.Image]:
+    """Converts one raw layer buffer to a resized PIL Image, or None if it is empty."""
+    if _is_buffer_empty(data, w, h): return None
+    img = _bgra_to_pil(data, w, h)
+    return resize_image_maintain_aspect(img) if img else None
+
+# Last processed context and the grab it came from (see process_capture)
+_ctx_cache: Optional[Tuple[CanvasCapture, Tuple[List[Image.Image], str]]] = None
+_ctx_lock = threading.Lock()
 
-def _is_image_empty(img: Image.Image) -> bool:
+def _same_capture(a: CanvasCapture, b: CanvasCapture) -> bool:
     """
-    Checks if an image is effectively empty (transparent or solid white).
-    Used for Smart Txt2Img detection.
+    Exact match without hashing: region and sizes first, then a byte compare
+    (memcmp) of the grabs, which stops at the first differing byte. An edit is
+    usually rejected almost immediately; a hit costs one linear compare, far
+    below a digest of the same buffer.
     """
-    if not img: return True
+    if (a.geometry, a.desc, a.multi_layer) != (b.geometry, b.desc, b.multi_layer): return False
+    if [(w, h) for _, w, h in a.buffers] != [(w, h) for _, w, h in b.buffers]: return False
+    return all(da == db for (da, _, _), (db, _, _) in zip(a.buffers, b.buffers))
+
+def invalidate_context_cache() -> None:
+    """Drops the cached context (e.g. after the document changes or a layer is applied)."""
+    global _ctx_cache
+    with _ctx_lock:
+        _ctx_cache = None
+
+def process_capture(capture: CanvasCapture, pool: Optional[Executor] = None) -> Tuple[List[Image.Image], str]:
+    """
+    Converts a CanvasCapture into reference images with Smart Detection.
+    Pure pixel work: safe to call from a worker thread. Large multi-layer
+    captures are spread over `pool` if given (the caller's long-lived pool).
     
-    # 1. Check Alpha Channel (Transparency)
-    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-        alpha = img.getchannel('A')
-        # Get min/max alpha values
-        min_a, max_a = alpha.getextrema()
-        if max_a == 0: return True # Fully transparent
-        
-    # 2. Check content on White Background (standard Krita new doc)
-    # Convert to RGB to check color values
-    rgb = img.convert('RGB')
+    Repeated sends/retries on an unchanged canvas reuse the previous result.
+    Krita has no per-stroke signal, so each grab is compared with the previous
+    one, which the cache keeps until the next miss or invalidate_context_cache.
+    
+    - Smart Detect: If content is Empty/White -> Txt2Img (returns empty list).
+    - If content exists -> Img2Img (returns list with image).
+
+    Returns:
+        Tuple of (List of PIL Images, Description string for UI)
+    """
+    global _ctx_cache
+    with _ctx_lock:
+        cached = _ctx_cache
+    if cached is not None and _same_capture(cached[0], capture):
+        images, desc = cached[1]
+        return (list(images), desc)
     
-    # Check if all pixels are white (255, 255, 255)
-    # We can check extrema. If min is 255 for all channels, it's pure white.
-    extrema = rgb.getextrema() # [(Rmin, Rmax), (Gmin, Gmax), (Bmin, Bmax)]
+    result = _convert_capture(capture, pool)
+    with _ctx_lock:
+        _ctx_cache = (capture, result)
+    return (list(result[0]), result[1])
+
+def _convert_capture(capture: CanvasCapture, pool: Optional[Executor] = None) -> Tuple[List[Image.Image], str]:
+    """Uncached body of process_capture."""
+    if capture.multi_layer:
+        # Layers are independent and PIL/NumPy release the GIL in their C loops,
+        # so convert them in parallel (map keeps the layer order). Many small
+        # layers are cheaper to convert inline than to hand to threads.
+        total_px = sum(w * h for _, w, h in capture.buffers)
+        if pool is not None and len(capture.buffers) > 1 and total_px >= _PARALLEL_MIN_PIXELS:
+            results = list(pool.map(lambda b: _process_layer(*b), capture.buffers))
+        else:
+            results = [_process_layer(*b) for b in capture.buffers]
+        images = [i for i in results if i is not None]
+        return (images, f"{len(images)} {capture.desc}")
     
-    is_white = all(min_val >= 250 for min_val, max_val in extrema) # Tolerance for compression artifacts/slight off-white
-    if is_white: return True
+    processed_imgs = []
+    final_desc = capture.desc
     
-    return False
+    for data, w, h in capture.buffers:
+        # Decide on the raw bytes; only non-empty grabs are decoded into PIL
+        if _is_buffer_empty(data, w, h):
+            logging.info("Smart Detect: Canvas/Selection is empty/white -> Mode: Txt2Img")
+            final_desc += " (Empty)"
+            continue
+        
+        img = _bgra_to_pil(data, w, h)
+        if img:
+            logging.info("Smart Detect: Content found -> Mode: Img2Img")
+            processed_imgs.append(resize_image_maintain_aspect(img))
+            final_desc += " (Ref)"
+                
+    return (processed_imgs, final_desc)
+
+def get_smart_context() -> Tuple[List[Image.Image], Tuple[int, int, int, int], str, str]:
+    """
+    Extracts context for generation based on Krita state with Smart Detection.
+    Convenience wrapper running capture_smart_context + process_capture in one go.
+
+    Returns:
+        Tuple containing:
+        - List of PIL Images (empty if Txt2Img, [img] if Img2Img)
+        - Geometry Tuple (x, y, w, h) for placement
+        - Description string (for UI)
+        - Aspect Ratio string (for API)
+    """
+    capture = capture_smart_context()
+    images, desc = process_capture(capture)
+    return (images, capture.geometry, desc, capture.aspect_ratio)
+
+def _is_buffer_empty(pixel_data: bytes, w: int, h: int) -> bool:
+    """
+    Checks if Krita's raw BGRA bytes are effectively empty (transparent or
+    solid white), for Smart Txt2Img detection. Works on a zero-copy view, so
+    empty layers are rejected before any PIL conversion. Mismatched buffers
+    are left to _bgra_to_pil, which reports them.
+    """
+    if len(pixel_data) != w * h * 4: return False
+    return _is_array_empty(np.frombuffer(pixel_data, dtype=np.uint8).reshape(h, w, 4))
+
+def _is_array_empty(arr: np.ndarray) -> bool:
+    """HxWx4 uint8 core of _is_buffer_empty; alpha is the last channel."""
+    if arr.size == 0: return True
+    
+    # Fast path: if a sparse grid sample already shows visible, non-white
+    # pixels, the image has content and the full buffer never gets scanned.
+    # Only a negative sample falls back to the exact full check below.
+    # Small images go straight to the full check.
+    if arr.shape[0] * arr.shape[1] >= _SAMPLE_MIN_PIXELS:
+        sample = arr[::_SAMPLE_STRIDE, ::_SAMPLE_STRIDE]
+        if sample[..., 3].any() and sample[..., :3].min() < 250:
+            return False
+    
+    # 1. Check Alpha Channel (Transparency)
+    # Only "any alpha > 0" matters, so a boolean reduction beats a min/max scan
+    if not arr[..., 3].any(): return True # Fully transparent
+        
+    # 2. Check content on White Background (standard Krita new doc)
+    # If min is >= 250 for all channels, it's (near) pure white.
+    # Tolerance for compression artifacts/slight off-white
+    return bool(arr[..., :3].min() >= 250)
 
 def delete_preview_layer() -> None:
     """Removes the preview layer if it exists (e.g., on Discard)."""
@@ -218,24 +362,25 @@ def update_preview_layer(pil_image: Image.Image, x: int = 0, y: int = 0, target_
         node = doc.nodeByName(layer_name)
         
         # Interpolation Logic
+        raw = None
         if target_w and target_h:
             if abs(pil_image.width - target_w) > 1 or abs(pil_image.height - target_h) > 1:
                 logging.info(f"Interpolating: {pil_image.size} -> {target_w}x{target_h}")
-                pil_image = pil_image.resize((target_w, target_h), Image.Resampling.LANCZOS)
+                if HAS_CV2 and _cv2_resizable(pil_image):
+                    raw = _resize_to_bgra(pil_image, target_w, target_h)
+                    w, h = target_w, target_h
+                else:
+                    pil_image = pil_image.resize((target_w, target_h), Image.Resampling.LANCZOS)
 
-        if pil_image.mode != 'RGBA': pil_image = pil_image.convert('RGBA')
-        w, h = pil_image.size
+        if raw is None:
+            if pil_image.mode != 'RGBA': pil_image = pil_image.convert('RGBA')
+            w, h = pil_image.size
+            # Create BGRA buffer for Krita (RGBA -> BGRA done by PIL's raw encoder).
+            raw = pil_image.tobytes('raw', 'BGRA')
         
-        # Create BGRA buffer for Krita
-        arr = np.array(pil_image)
-        bgra = np.zeros((h, w, 4), dtype=np.uint8)
-        # RGBA -> BGRA
-        bgra[:, :, 0] = arr[:, :, 2] # B
-        bgra[:, :, 1] = arr[:, :, 1] # G
-        bgra[:, :, 2] = arr[:, :, 0] # R
-        bgra[:, :, 3] = arr[:, :, 3] # A
-        
-        pixel_bytes = QByteArray(bgra.tobytes())
+        # fromRawData wraps the bytes without a second whole-image copy, so
+        # `raw` must stay referenced until setPixelData has consumed it.
+        pixel_bytes = QByteArray.fromRawData(raw)
         
         if not node:
             root = doc.rootNode()
@@ -251,6 +396,17 @@ def update_preview_layer(pil_image: Image.Image, x: int = 0, y: int = 0, target_
         logging.error(f"Preview error: {e}", exc_info=True)
         return False
 
+def _resize_to_bgra(pil_image: Image.Image, w: int, h: int) -> bytes:
+    """
+    cv2 path for update_preview_layer (opaque images only, see _cv2_resizable):
+    resizes, then swaps to BGRA in place, skipping PIL's resized-image copy.
+    """
+    src = np.asarray(pil_image if pil_image.mode in ('RGB', 'RGBA') else pil_image.convert('RGB'))
+    dst = cv2.resize(src, (w, h), interpolation=cv2.INTER_LANCZOS4)
+    if dst.shape[2] == 4:
+        return cv2.cvtColor(dst, cv2.COLOR_RGBA2BGRA, dst=dst).tobytes()
+    return cv2.cvtColor(dst, cv2.COLOR_RGB2BGRA).tobytes() # adds opaque alpha
+
 def apply_preview_layer(final_name: str) -> None:
     """Renames the preview layer to finalize it."""
     try:
@@ -6,46 +6,104 @@ from PyQt5.QtWidgets import (
     QSlider, QAbstractItemView, QSplitter, QStyle, QGridLayout
 )
 from PyQt5.QtCore import (
-    QThread, pyqtSignal, Qt, QEvent, QObject, QSize, QTimer
+    pyqtSignal, Qt, QEvent, QObject, QSize, QTimer
 )
 from PyQt5.QtGui import (
     QTextCursor, QFont, QIcon, QPixmap, QImage, QColor, QPalette
 )
 from typing import Optional, List, Tuple, Any
 from PIL import Image
+import numpy as np
 import io
 import logging
+import os
 import random
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from .gemini_api import GeminiClient
+from .gemini_api import GeminiClient, JPEG_QUALITY, UPLOAD_MAX_DIMENSION, MAX_HISTORY_TURNS
 from .krita_api import (
-    get_smart_context, update_preview_layer, apply_preview_layer, 
-    delete_preview_layer, get_canvas_dimensions, get_nearest_supported_ar
+    CanvasCapture, capture_smart_context, process_capture, invalidate_context_cache, update_preview_layer, 
+    apply_preview_layer, delete_preview_layer, get_canvas_dimensions, get_nearest_supported_ar
 )
 from .utils import NanobananaSettings
 
 # --- Utils ---
-def pil2pixmap(im):
-    """Converts PIL Image to QPixmap, handling BGR/RGB channel swapping for Qt."""
-    if im.mode != "RGBA":
-        im = im.convert("RGBA")
-    
-    # Qt QImage.Format_ARGB32 expects data in BGRA order on Little Endian (Windows/Linux x64)
-    # So we swap R and B channels from PIL's RGBA
-    r, g, b, a = im.split()
-    im_bgra = Image.merge("RGBA", (b, g, r, a))
-    
-    data = im_bgra.tobytes("raw", "RGBA")
-    qim = QImage(data, im.size[0], im.size[1], QImage.Format_ARGB32)
-    return QPixmap.fromImage(qim)
+THUMB_WIDTH = 160
+MAX_CHAT_BUBBLES = 100 # Live bubble widgets; older turns are kept as plain records
+OLDER_PAGE = 20 # Records rebuilt into bubbles per "show older" step
+IMAGE_STORE_SIZE = 32 # Full-res results kept for Preview/Apply
+TEXT_FLUSH_MS = 16 # Streamed text is drawn at most once per frame
+
+def pil2qimage(im):
+    """
+    Converts PIL Image to a QImage backed by a single BGRA buffer. Safe to call off the GUI thread (unlike QPixmap).
+    PIL's raw encoder swaps to BGRA in C, which is Format_ARGB32 (Qt's native raster order) on little-endian.
+    """
+    w, h = im.size
+    if im.mode == "RGB":
+        # Common for model output: fill BGRA + opaque alpha in one buffer instead of convert("RGBA") first
+        a = np.asarray(im)
+        buf = np.empty((h, w, 4), np.uint8)
+        buf[..., :3] = a[..., ::-1]
+        buf[..., 3] = 255
+        data = buf.data
+    else:
+        if im.mode != "RGBA":
+            im = im.convert("RGBA")
+        buf = data = im.tobytes("raw", "BGRA")
+    # QImage borrows the buffer (explicit 4*w stride). Instead of copy(), the wrapper keeps it
+    # alive, also across the signal to the GUI thread; QPixmap.fromImage makes the only copy.
+    qim = QImage(data, w, h, 4 * w, QImage.Format_ARGB32)
+    qim._buf = buf
+    return qim
+
+def make_thumbnail(im: Image.Image, width: int = THUMB_WIDTH) -> Image.Image:
+    """Scales a PIL image to the chat thumbnail width, so only thumbnail-sized pixels reach Qt."""
+    w, h = im.size
+    if w <= width: return im
+    return im.resize((width, max(1, round(h * width / w))), Image.Resampling.BILINEAR)
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: allows bursts of `capacity` requests, then paces
+    callers to one request per `refill_interval` seconds.
+    """
+    def __init__(self, capacity: int, refill_interval: float):
+        self.capacity = capacity
+        self.refill_interval = refill_interval
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) / self.refill_interval)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.refill_interval
+            time.sleep(wait)
+
+# Shared by all workers: protects against "API empty responses" under load
+# without a fixed sleep when the server would accept the request right away
+_api_limiter = RateLimiter(capacity=2, refill_interval=1.0)
 
 # --- Custom Widgets ---
 
 class ClickableLabel(QLabel):
-    clicked = pyqtSignal()
+    clicked = pyqtSignal(int) # seed
+    def __init__(self, seed: int = -1, parent=None):
+        super().__init__(parent)
+        self.seed = seed
     def mousePressEvent(self, event):
-        self.clicked.emit()
+        self.clicked.emit(self.seed)
         super().mousePressEvent(event)
 
 class ChatBubble(QFrame):
@@ -53,7 +111,33 @@ class ChatBubble(QFrame):
     A message bubble widget. 
     Can hold text and/or images.
     """
-    image_clicked_signal = pyqtSignal(object, int) # (QPixmap, seed/id)
+    image_clicked_signal = pyqtSignal(int) # seed/id; images live in the widget's store
+
+    # Installed once on NanobananaChatWidget instead of per bubble
+    ROLE_QSS = """
+        ChatBubble[role="user"] { 
+            background-color: #1976D2; 
+            border-radius: 12px; 
+            border-bottom-right-radius: 2px;
+            margin-left: 40px;
+        }
+        ChatBubble[role="user"] QLabel { color: white; background: transparent; }
+        ChatBubble[role="model"] { 
+            background-color: #3E3E3E; 
+            border-radius: 12px; 
+            border-bottom-left-radius: 2px;
+            margin-right: 40px;
+        }
+        ChatBubble[role="model"] QLabel { color: #E0E0E0; background: transparent; }
+        ChatBubble[role="sys"] { 
+            background-color: #3E2723; 
+            border: 1px solid #D32F2F;
+            border-radius: 8px; 
+        }
+        ChatBubble[role="sys"] QLabel { color: #FFCDD2; background: transparent; font-style: italic; }
+    """
+    # Shared by all bubbles; created lazily because QFont needs a QApplication
+    _FONT: Optional[QFont] = None
 
     def __init__(self, role="model", text="", parent=None):
         super().__init__(parent)
@@ -73,40 +157,16 @@ class ChatBubble(QFrame):
         self.lbl_text.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
         
         # Styling based on role
-        font = QFont("Segoe UI", 10) 
-        self.lbl_text.setFont(font)
+        if ChatBubble._FONT is None:
+            ChatBubble._FONT = QFont("Segoe UI", 10)
+        self.lbl_text.setFont(ChatBubble._FONT)
         
+        # Colours come from ROLE_QSS on the chat widget (parsed once), selected by this property
+        self.setProperty("role", role if role in ("user", "model") else "sys")
         if role == "user":
-            self.setStyleSheet("""
-                ChatBubble { 
-                    background-color: #1976D2; 
-                    border-radius: 12px; 
-                    border-bottom-right-radius: 2px;
-                    margin-left: 40px;
-                }
-                QLabel { color: white; background: transparent; }
-            """)
             self.layout.setAlignment(Qt.AlignRight)
         elif role == "model":
-            self.setStyleSheet("""
-                ChatBubble { 
-                    background-color: #3E3E3E; 
-                    border-radius: 12px; 
-                    border-bottom-left-radius: 2px;
-                    margin-right: 40px;
-                }
-                QLabel { color: #E0E0E0; background: transparent; }
-            """)
             self.layout.setAlignment(Qt.AlignLeft)
-        else: # System/Error
-            self.setStyleSheet("""
-                ChatBubble { 
-                    background-color: #3E2723; 
-                    border: 1px solid #D32F2F;
-                    border-radius: 8px; 
-                }
-                QLabel { color: #FFCDD2; background: transparent; font-style: italic; }
-            """)
 
         self.layout.addWidget(self.lbl_text)
         
@@ -117,12 +177,17 @@ class ChatBubble(QFrame):
         self.image_grid.setSpacing(4)
         self.layout.addWidget(self.image_grid_widget)
         self.image_count = 0
+        self.images: List[Tuple[QImage, int]] = [] # (thumbnail, seed), to rebuild this bubble later
 
     def append_text(self, chunk: str):
         current = self.lbl_text.text()
         self.lbl_text.setText(current + chunk)
 
-    def add_image(self, pixmap: QPixmap, image_data: Image.Image, seed: int):
+    def record(self) -> Tuple[str, str, List[Tuple[QImage, int]]]:
+        """Widget-free copy of this bubble (role, text, thumbnails) for the scrollback."""
+        return (self.role, self.lbl_text.text(), list(self.images))
+
+    def add_image(self, thumb: QImage, seed: int):
         # Calculate grid position (3 columns)
         row = self.image_count // 3
         col = self.image_count % 3
@@ -133,18 +198,16 @@ class ChatBubble(QFrame):
         l.setContentsMargins(0,0,0,0)
         l.setSpacing(2)
         
-        lbl_img = ClickableLabel()
+        lbl_img = ClickableLabel(seed)
         lbl_img.setCursor(Qt.PointingHandCursor)
         
-        # Scale down for thumbnail (160px)
-        thumb_pixmap = pixmap.scaledToWidth(160, Qt.SmoothTransformation)
-        lbl_img.setPixmap(thumb_pixmap)
+        # Thumbnail already arrives at its display size (see make_thumbnail).
+        # The label owns the pixmap, so it goes away with its bubble.
+        lbl_img.setPixmap(QPixmap.fromImage(thumb))
+        self.images.append((thumb, seed))
         
-        # Connect click safely using a closure helper
-        def make_handler(img, s):
-            return lambda: self.image_clicked_signal.emit(img, s)
-            
-        lbl_img.clicked.connect(make_handler(image_data, seed))
+        # Forward the label's seed straight to the bubble signal (no per-image closure)
+        lbl_img.clicked.connect(self.image_clicked_signal)
         
         l.addWidget(lbl_img)
         
@@ -159,72 +222,142 @@ class ChatBubble(QFrame):
 
 # --- Workers ---
 
-class MagicWorker(QThread):
+# Persistent pools shared by every prompt: workers submit to them, no thread is created per send.
+# Network calls (mostly waiting on Gemini) and pixel work are kept apart so a burst
+# of thumbnail conversions never delays a request, and slow requests never hold up decoding.
+_NET_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="nanobanana-net")
+_CPU_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="nanobanana-cpu")
+_STOPPING = threading.Event() # set on shutdown; running streams stop at their next chunk
+
+def _shutdown_pools() -> None:
+    """
+    Called when Krita closes. Queued work is dropped and running streams bail out early,
+    so interpreter exit (which joins pool threads) isn't held up by a Gemini request.
+    """
+    _STOPPING.set()
+    _NET_POOL.shutdown(wait=False, cancel_futures=True)
+    _CPU_POOL.shutdown(wait=False, cancel_futures=True)
+
+class MagicWorker(QObject):
+    """Runs prompt enhancement on _NET_POOL; signals are queued to the GUI thread."""
     result_signal = pyqtSignal(dict)
     error_signal = pyqtSignal(str)
+    concept_signal = pyqtSignal(str)
 
-    def __init__(self, client: GeminiClient, prompt: str, images: List[Image.Image]):
+    def __init__(self, client: GeminiClient, prompt: str, capture: CanvasCapture):
         super().__init__()
         self.client = client
         self.prompt = prompt
-        self.images = images
+        self.capture = capture
+
+    def start(self) -> None:
+        _NET_POOL.submit(self.run)
 
     def run(self):
         try:
-            result = self.client.enhance_prompt(self.prompt, self.images)
+            # Pixel conversion runs here, off the GUI thread
+            images, _ = process_capture(self.capture, _CPU_POOL)
+            result = self.client.enhance_prompt(self.prompt, images, on_concept=self.concept_signal.emit)
             self.result_signal.emit(result)
         except Exception as e:
             self.error_signal.emit(str(e))
 
-class GenerationWorker(QThread):
+class GenerationWorker(QObject):
+    """
+    Runs one prompt (plus batch variations) on _NET_POOL; thumbnails are built on _CPU_POOL.
+    Signals are emitted from pool threads; Qt queues them to the GUI thread.
+    """
     text_chunk_signal = pyqtSignal(str)
-    image_received_signal = pyqtSignal(object, int, int) 
+    image_received_signal = pyqtSignal(object, object, int, int) # (PIL image, thumbnail QImage, seed, idx)
     finished_signal = pyqtSignal()
     error_signal = pyqtSignal(str)
     progress_signal = pyqtSignal(str)
 
-    def __init__(self, client: GeminiClient, prompt: str, images: List[Image.Image], seed: int, model: str, aspect_ratio: str, batch_count: int, image_size: str = "1K"):
+    def __init__(self, client: GeminiClient, prompt: str, capture: CanvasCapture, seed: int, model: str, aspect_ratio: str, batch_count: int, image_size: str = "1K"):
         super().__init__()
         self.client = client
         self.prompt = prompt
-        self.images = images
+        self.capture = capture
+        self.images: List[Image.Image] = []
         self.seed = seed
         self.model = model
         self.aspect_ratio = aspect_ratio
         self.batch_count = batch_count
         self.image_size = image_size
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        _NET_POOL.submit(self.run)
 
     def run(self) -> None:
         if not self.client: return
         
-        for i in range(self.batch_count):
-            try:
-                self.progress_signal.emit(f"Generating {i+1}/{self.batch_count}...")
-                
-                # Completely random seed for each generation in batch
-                sid = random.randint(0, 2**31)
-                
-                # Throttle to prevent API empty responses
-                if i > 0: time.sleep(1.5) 
-                
-                # First image usually updates context (Chat History), subsequent are variations (Stateless)
-                if i == 0:
-                    stream = self.client.send_prompt(self.prompt, self.images, sid, self.model, self.aspect_ratio, self.image_size)
-                else:
-                    stream = self.client.generate_variation(self.prompt, self.images, sid, self.model, self.aspect_ratio, self.image_size)
-                
-                for text, img in stream:
-                    if text and i == 0: 
-                        self.text_chunk_signal.emit(text)
-                    if img: 
-                        self.image_received_signal.emit(img, sid, i)
-                        
-            except Exception as e:
-                logging.error(f"Worker Generation Error (Batch {i+1}): {e}", exc_info=True)
-                # Report error to chat but continue batch
-                self.text_chunk_signal.emit(f"\n[System: Var {i+1} failed: {e}]")
+        # Convert the raw canvas grab off the GUI thread
+        self.progress_signal.emit("Analyzing Canvas...")
+        try:
+            self.images, _ = process_capture(self.capture, _CPU_POOL)
+        except Exception as e:
+            logging.error(f"Context processing failed: {e}", exc_info=True)
+            self.error_signal.emit(f"Failed to read canvas: {e}")
+            return
         
-        self.finished_signal.emit()
+        # First image updates context (Chat History) and must land first.
+        # The rest are stateless variations: I/O-bound, so run them concurrently.
+        self._generate(0)
+        if self.batch_count <= 1:
+            self.finished_signal.emit()
+            return
+        
+        # No blocking wait here: the last variation to finish reports completion
+        self._pending = self.batch_count - 1
+        for i in range(1, self.batch_count):
+            _NET_POOL.submit(self._variation, i)
+
+    def _emit_image(self, img: Image.Image, sid: int, i: int) -> None:
+        """Thumbnail pixel work happens here; the GUI thread only wraps it in a QPixmap."""
+        thumb = pil2qimage(make_thumbnail(img))
+        self.image_received_signal.emit(img, thumb, sid, i)
+
+    def _variation(self, i: int) -> None:
+        self._generate(i)
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done: self.finished_signal.emit()
+
+    def _generate(self, i: int) -> None:
+        """Runs batch item i (0 = chat turn, >0 = variation). Called from worker threads."""
+        try:
+            self.progress_signal.emit(f"Generating {i+1}/{self.batch_count}...")
+            
+            # Completely random seed for each generation in batch
+            sid = random.randint(0, 2**31)
+            
+            # Throttle to prevent API empty responses
+            _api_limiter.acquire()
+            
+            if i == 0:
+                stream = self.client.send_prompt(self.prompt, self.images, sid, self.model, self.aspect_ratio, self.image_size)
+            else:
+                stream = self.client.generate_variation(self.prompt, self.images, sid, self.model, self.aspect_ratio, self.image_size)
+            
+            conversions = []
+            for text, img in stream:
+                if _STOPPING.is_set(): return
+                if text and i == 0: 
+                    self.text_chunk_signal.emit(text)
+                if img: 
+                    # Keep reading the stream while the thumbnail is built
+                    conversions.append(_CPU_POOL.submit(self._emit_image, img, sid, i))
+            
+            # All images of this item must be delivered before finished_signal
+            for f in conversions: f.result()
+                    
+        except Exception as e:
+            logging.error(f"Worker Generation Error (Batch {i+1}): {e}", exc_info=True)
+            # Report error to chat but continue batch
+            self.text_chunk_signal.emit(f"\n[System: Var {i+1} failed: {e}]")
 
 # --- Main Widget ---
 
@@ -238,6 +371,14 @@ class NanobananaChatWidget(QWidget):
         self.batch_results = [] # Track results for applying
         self.last_geometry: Tuple[int, int, int, int] = (0, 0, 0, 0)
         self.current_ai_bubble: Optional[ChatBubble] = None
+        # Full-res results by seed (LRU); bubbles only hold the seed
+        self._image_store: "OrderedDict[int, Image.Image]" = OrderedDict()
+        self._scroll_pending = False
+        self._older_records: List[Tuple[str, str, List[Tuple[QImage, int]]]] = [] # scrollback, oldest first
+        self._text_pending: List[str] = [] # streamed fragments not yet drawn
+        self._user_prompts: List[str] = [] # Prompts of recorded history turns, newest last (for retry)
+        self._in_flight: Optional[Tuple[str, Any]] = None # (prompt, history tail at send)
+        self._failed_prompt: Optional[str] = None # last send that left no history turn
         
         # Selection State
         self.selected_image: Optional[Image.Image] = None
@@ -247,10 +388,21 @@ class NanobananaChatWidget(QWidget):
         self.setup_ui()
 
     def setup_api(self) -> None:
+        # Parse generation settings once per change rather than on every send
+        set_ar = self.settings.get("aspect_ratio", "Canvas (Native)")
+        self._ar_spec: Optional[str] = None if "Native" in set_ar else set_ar.split()[0]
+        self._model: str = self.settings.get("model")
+        self._image_size: str = self.settings.get("image_size", "1K")
+        
         key = self.settings.get("api_key") or ""
         if key:
             try:
-                self.client = GeminiClient(key)
+                self.client = GeminiClient(
+                    key,
+                    jpeg_quality=self.settings.get("upload_jpeg_quality", JPEG_QUALITY),
+                    upload_max_dim=self.settings.get("upload_max_dim", UPLOAD_MAX_DIMENSION),
+                    history_limit=self.settings.get("history_limit", MAX_HISTORY_TURNS * 2)
+                )
             except Exception as e:
                 self.add_message("sys", f"API Error: {e}")
         else:
@@ -277,7 +429,7 @@ class NanobananaChatWidget(QWidget):
             }
             QPushButton:hover { background: #505050; border-color: #777; }
             QPushButton:pressed { background: #303030; }
-        """)
+        """ + ChatBubble.ROLE_QSS)
         
         main_layout = QVBoxLayout(self)
         main_layout.setSpacing(0)
@@ -319,12 +471,27 @@ class NanobananaChatWidget(QWidget):
         self.scroll = QScrollArea()
         self.scroll.setWidgetResizable(True)
         self.scroll_content = QWidget()
-        self.chat_layout = QVBoxLayout(self.scroll_content)
+        content_layout = QVBoxLayout(self.scroll_content)
+        content_layout.setContentsMargins(0, 0, 0, 0)
+        content_layout.setSpacing(0)
+        
+        # Scrollback beyond MAX_CHAT_BUBBLES: shown on click or when scrolled to the top
+        self.btn_older = QPushButton()
+        self.btn_older.setFlat(True)
+        self.btn_older.setStyleSheet("color: #888; font-size: 11px; padding: 6px;")
+        self.btn_older.clicked.connect(self.show_older_messages)
+        self.btn_older.hide()
+        content_layout.addWidget(self.btn_older)
+        
+        chat_host = QWidget()
+        self.chat_layout = QVBoxLayout(chat_host)
         self.chat_layout.addStretch() # Push messages to bottom
         self.chat_layout.setSpacing(12)
         self.chat_layout.setContentsMargins(12, 12, 12, 12)
+        content_layout.addWidget(chat_host, 1)
         
         self.scroll.setWidget(self.scroll_content)
+        self.scroll.verticalScrollBar().valueChanged.connect(self._on_chat_scrolled)
         main_layout.addWidget(self.scroll, 1) # Expands
 
         # 3. Preview Bar (Hidden by default)
@@ -411,16 +578,61 @@ class NanobananaChatWidget(QWidget):
                 return True
         return super().eventFilter(o, e)
 
-    def add_message(self, role: str, text: str) -> ChatBubble:
+    def _make_bubble(self, role: str, text: str) -> ChatBubble:
         bubble = ChatBubble(role, text)
         # Connect the bubble's image click signal to the main handler
         bubble.image_clicked_signal.connect(self.on_image_clicked)
+        return bubble
+
+    def add_message(self, role: str, text: str) -> ChatBubble:
+        bubble = self._make_bubble(role, text)
         self.chat_layout.addWidget(bubble)
         
-        # Auto-scroll
-        QTimer.singleShot(100, lambda: self.scroll.verticalScrollBar().setValue(self.scroll.verticalScrollBar().maximum()))
+        # Keep the widget tree bounded: the oldest bubbles (index 0 is the stretch)
+        # become plain records, rebuilt by show_older_messages when scrolled back to.
+        while self.chat_layout.count() - 1 > MAX_CHAT_BUBBLES:
+            w = self.chat_layout.takeAt(1).widget()
+            if w:
+                self._older_records.append(w.record())
+                w.deleteLater()
+        self._update_older_button()
+        
+        self._schedule_scroll()
         return bubble
 
+    def show_older_messages(self) -> None:
+        """Rebuilds the newest OLDER_PAGE hidden records into bubbles above the visible ones."""
+        if not self._older_records: return
+        self.scroll_content.setUpdatesEnabled(False)
+        for _ in range(min(OLDER_PAGE, len(self._older_records))):
+            role, text, images = self._older_records.pop()
+            bubble = self._make_bubble(role, text)
+            for thumb, seed in images:
+                bubble.add_image(thumb, seed)
+            self.chat_layout.insertWidget(1, bubble)
+        self.scroll_content.setUpdatesEnabled(True)
+        self._update_older_button()
+
+    def _on_chat_scrolled(self, value: int) -> None:
+        if value == 0 and self._older_records:
+            self.show_older_messages()
+
+    def _update_older_button(self) -> None:
+        n = len(self._older_records)
+        self.btn_older.setText(f"▲ {n} older message{'s' if n != 1 else ''} hidden (show more)")
+        self.btn_older.setVisible(n > 0)
+
+    def _schedule_scroll(self) -> None:
+        """Auto-scroll to bottom, at most once per frame however many chunks arrive."""
+        if self._scroll_pending: return
+        self._scroll_pending = True
+        QTimer.singleShot(16, self._flush_scroll)
+
+    def _flush_scroll(self) -> None:
+        sb = self.scroll.verticalScrollBar()
+        sb.setValue(sb.maximum())
+        self._scroll_pending = False
+
     def start_magic(self):
         txt = self.inp.toPlainText().strip()
         if not self.client: return
@@ -432,10 +644,11 @@ class NanobananaChatWidget(QWidget):
         self.inp.setEnabled(False)
         self.lbl_status.setText("✨ Doing Magic...")
         
-        # Get Context
-        images, geom, desc, ar = get_smart_context()
+        # Grab Context (conversion happens in the worker)
+        capture = capture_smart_context()
         
-        self.magic_worker = MagicWorker(self.client, txt, images)
+        self.magic_worker = MagicWorker(self.client, txt, capture)
+        self.magic_worker.concept_signal.connect(lambda c: self.lbl_status.setText(f"✨ {c}..."))
         self.magic_worker.result_signal.connect(self.apply_magic)
         self.magic_worker.error_signal.connect(self.on_magic_err)
         self.magic_worker.start()
@@ -486,13 +699,17 @@ class NanobananaChatWidget(QWidget):
         
         # 2. Add User Bubble
         self.add_message("user", disp_text)
+        history = self.client.history
+        self._in_flight = (disp_text, history[-1] if history else None)
+        self._failed_prompt = None
         
         # 3. Prepare Context
         self.lbl_status.setText("Analyzing Canvas...")
         QApplication.processEvents()
         
-        images, geom, desc, calc_ar = get_smart_context()
-        self.last_geometry = geom
+        capture = capture_smart_context()
+        self.last_geometry = capture.geometry
+        calc_ar = capture.aspect_ratio
         
         self.lbl_status.setText(f"Initializing...")
 
@@ -504,13 +721,12 @@ class NanobananaChatWidget(QWidget):
         self.settings.set("batch_size", batch)
         
         # Use Settings AR or Calculated AR
-        set_ar = self.settings.get("aspect_ratio", "Canvas (Native)")
-        ar_req = calc_ar if "Native" in set_ar else set_ar.split()[0]
+        ar_req = calc_ar if self._ar_spec is None else self._ar_spec
         
         seed = random.randint(0, 2**31)
 
         self.worker = GenerationWorker(
-            self.client, txt, images, seed, self.settings.get("model"), ar_req, batch, self.settings.get("image_size", "1K")
+            self.client, txt, capture, seed, self._model, ar_req, batch, self._image_size
         )
         self.worker.text_chunk_signal.connect(self.handle_text)
         self.worker.image_received_signal.connect(self.handle_image)
@@ -523,26 +739,42 @@ class NanobananaChatWidget(QWidget):
         self.lbl_status.setText(status)
 
     def handle_text(self, chunk: str):
-        if self.current_ai_bubble:
-            self.current_ai_bubble.append_text(chunk)
-            # Scroll to bottom
-            sb = self.scroll.verticalScrollBar()
-            sb.setValue(sb.maximum())
-
-    def handle_image(self, img: Image.Image, seed: int, idx: int):
+        """Buffers a streamed fragment; re-setting the label per token would relayout every time."""
+        if not self.current_ai_bubble: return
+        self._text_pending.append(chunk)
+        if len(self._text_pending) == 1:
+            QTimer.singleShot(TEXT_FLUSH_MS, self._flush_text)
+
+    def _flush_text(self) -> None:
+        if self._text_pending and self.current_ai_bubble:
+            self.current_ai_bubble.append_text("".join(self._text_pending))
+            self._schedule_scroll()
+        self._text_pending.clear()
+
+    def handle_image(self, img: Image.Image, thumb: QImage, seed: int, idx: int):
         self.batch_results.append(img)
+        self._image_store[seed] = img
+        if len(self._image_store) > IMAGE_STORE_SIZE:
+            self._image_store.popitem(last=False)
+        
         if self.current_ai_bubble:
-            # Add thumbnail to the bubble
-            self.current_ai_bubble.add_image(pil2pixmap(img), img, seed)
+            # Add thumbnail to the bubble; the worker already built the QImage
+            self.current_ai_bubble.add_image(thumb, seed)
         
         # Auto-select the LAST received image as current preview
-        self.on_image_clicked(img, seed)
+        self.on_image_clicked(seed)
 
-    def on_image_clicked(self, img: Image.Image, seed: int):
+    def on_image_clicked(self, seed: int):
         """
         Handles selection of an image from the chat history.
         Updates the virtual preview layer and state.
         """
+        img = self._image_store.get(seed)
+        if img is None:
+            self.lbl_status.setText(f"Seed {seed} is no longer cached")
+            return
+        self._image_store.move_to_end(seed)
+        
         self.selected_image = img
         self.selected_seed = seed
         
@@ -555,7 +787,20 @@ class NanobananaChatWidget(QWidget):
         self.preview_lbl.setText(f"Preview: Seed {seed}")
         self.lbl_status.setText(f"Selected: {seed}")
 
+    def _record_turn(self) -> None:
+        """Pairs the sent prompt with a history turn, but only if the client recorded one."""
+        if self._in_flight is None: return
+        text, tail = self._in_flight
+        self._in_flight = None
+        history = self.client.history if self.client else None
+        if history and history[-1] is not tail:
+            self._user_prompts.append(text)
+        else:
+            self._failed_prompt = text
+
     def on_finish(self):
+        self._flush_text() # don't wait for the timer
+        self._record_turn()
         self.inp.setEnabled(True)
         self.btn_send.setEnabled(True)
         self.btn_retry.setEnabled(True)
@@ -569,6 +814,7 @@ class NanobananaChatWidget(QWidget):
 
     def on_err(self, err: str):
         # Only for catastrophic setup errors (not individual batch errors which are handled in loop)
+        self._record_turn()
         self.inp.setEnabled(True)
         self.btn_send.setEnabled(True)
         self.btn_retry.setEnabled(True)
@@ -582,6 +828,7 @@ class NanobananaChatWidget(QWidget):
         # Apply the CURRENTLY SELECTED preview as a permanent layer
         # We use the seed to name it uniquely
         apply_preview_layer(f"AI Gen {self.selected_seed}")
+        invalidate_context_cache()
         
         self.add_message("sys", f"Applied 'AI Gen {self.selected_seed}' to canvas.")
         
@@ -605,45 +852,38 @@ class NanobananaChatWidget(QWidget):
         
         # Iterate backwards, skipping the stretch item (index 0 usually, but let's be safe)
         # actually stretch is added first, so it's at index 0.
-        
+        self.scroll_content.setUpdatesEnabled(False)
         while count > 1 and removed_count < 2:
             item = self.chat_layout.takeAt(count - 1)
             if item.widget():
                 item.widget().deleteLater()
                 removed_count += 1
             count = self.chat_layout.count()
+        self.scroll_content.setUpdatesEnabled(True)
 
     def undo_last(self):
         if self.client and self.client.undo_last_turn():
+            if self._user_prompts: self._user_prompts.pop()
+            self._failed_prompt = None
             self.remove_last_interaction()
             self.add_message("sys", "↺ Last turn undone.")
             self.discard_layer()
 
     def retry_last(self):
         """
-        1. Identify last user text (from UI or history?)
-           Better from UI to be safe.
-        2. Undo last turn (Backend + UI).
+        1. Take the last sent prompt.
+        2. Undo last turn (Backend + UI); a failed send has no turn to undo.
         3. Put text in input.
         4. Click send.
         """
-        # Find last user message text
-        last_user_text = ""
-        
-        # Scan backwards for a user bubble
-        for i in range(self.chat_layout.count() - 1, -1, -1):
-            w = self.chat_layout.itemAt(i).widget()
-            if isinstance(w, ChatBubble) and w.role == "user":
-                last_user_text = w.lbl_text.text()
-                break
-        
-        if not last_user_text:
+        if self._failed_prompt:
+            # The last send never made it into history: nothing to undo, just resend
+            last_user_text, self._failed_prompt = self._failed_prompt, None
+        elif self._user_prompts and self.client and self.client.undo_last_turn():
+            last_user_text = self._user_prompts.pop()
+        else:
             self.add_message("sys", "Nothing to retry.")
             return
-
-        # Undo
-        if self.client:
-            self.client.undo_last_turn() # Backend
         self.remove_last_interaction() # UI
         
         # Setup Retry
@@ -652,56 +892,77 @@ class NanobananaChatWidget(QWidget):
 
     def reset_session(self):
         if self.client: self.client.reset_session()
-        # Clear UI
-        while self.chat_layout.count() > 1: # Keep the stretch item
-            item = self.chat_layout.takeAt(0)
-            if item.widget(): item.widget().deleteLater()
+        self._user_prompts.clear()
+        self._failed_prompt = None
+        self._older_records.clear()
+        self._update_older_button()
+        # Clear UI from the back (takeAt(0) shifts the whole list each time);
+        # one repaint at the end instead of one per removed bubble
+        self.scroll_content.setUpdatesEnabled(False)
+        for i in range(self.chat_layout.count() - 1, 0, -1): # Keep the stretch item at 0
+            w = self.chat_layout.takeAt(i).widget()
+            if w:
+                w.setParent(None)
+                w.deleteLater()
+        self.scroll_content.setUpdatesEnabled(True)
         self.discard_layer()
         self.add_message("sys", "Session Reset.")
 
     def show_settings(self):
+        # Built once and reused; fields are refreshed from settings on every open
+        if getattr(self, "_settings_dialog", None) is None:
+            self._settings_dialog = self._build_settings_dialog()
+        
+        self._set_key.setText(self.settings.get("api_key", ""))
+        self._set_model.setCurrentText(self.settings.get("model", "gemini-2.5-flash-image"))
+        self._set_size.setCurrentText(self.settings.get("image_size", "1K"))
+        self._set_ar.setCurrentText(self.settings.get("aspect_ratio", "Canvas (Native)"))
+        self._settings_dialog.exec_()
+
+    def _build_settings_dialog(self) -> QDialog:
         d = QDialog(self)
         d.setWindowTitle("Settings")
         d.setStyleSheet("background: #333; color: #eee;")
         f = QFormLayout(d)
         
-        k = QLineEdit(self.settings.get("api_key",""))
-        k.setEchoMode(QLineEdit.Password)
-        f.addRow("API Key:", k)
+        self._set_key = QLineEdit()
+        self._set_key.setEchoMode(QLineEdit.Password)
+        f.addRow("API Key:", self._set_key)
         
-        m = QComboBox()
-        m.addItems(["gemini-2.5-flash-image", "gemini-2.5-pro", "gemini-3-pro-preview", "gemini-3-pro-image-preview"])
-        m.setCurrentText(self.settings.get("model", "gemini-2.5-flash-image"))
-        f.addRow("Model:", m)
+        self._set_model = QComboBox()
+        self._set_model.addItems(["gemini-2.5-flash-image", "gemini-2.5-pro", "gemini-3-pro-preview", "gemini-3-pro-image-preview"])
+        f.addRow("Model:", self._set_model)
         
-        sz = QComboBox()
-        sz.addItems(["1K", "2K", "4K"])
-        sz.setCurrentText(self.settings.get("image_size", "1K"))
-        f.addRow("Image Size (Gemini 3+):", sz)
+        self._set_size = QComboBox()
+        self._set_size.addItems(["1K", "2K", "4K"])
+        f.addRow("Image Size (Gemini 3+):", self._set_size)
         
-        ar = QComboBox()
-        ar.addItems(["Canvas (Native)", "1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9"])
-        ar.setCurrentText(self.settings.get("aspect_ratio", "Canvas (Native)"))
-        f.addRow("AR Strategy:", ar)
+        self._set_ar = QComboBox()
+        self._set_ar.addItems(["Canvas (Native)", "1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9"])
+        f.addRow("AR Strategy:", self._set_ar)
         
         btn = QDialogButtonBox(QDialogButtonBox.Save | QDialogButtonBox.Cancel)
-        btn.accepted.connect(lambda: [
-            self.settings.set("api_key", k.text()), 
-            self.settings.set("model", m.currentText()),
-            self.settings.set("image_size", sz.currentText()),
-            self.settings.set("aspect_ratio", ar.currentText()),
-            self.setup_api(), 
-            d.accept()
-        ])
+        btn.accepted.connect(self._save_settings)
         btn.rejected.connect(d.reject)
         f.addRow(btn)
-        d.exec_()
+        return d
+
+    def _save_settings(self):
+        self.settings.set("api_key", self._set_key.text())
+        self.settings.set("model", self._set_model.currentText())
+        self.settings.set("image_size", self._set_size.currentText())
+        self.settings.set("aspect_ratio", self._set_ar.currentText())
+        self.setup_api()
+        self._settings_dialog.accept()
 
 class NanobananaDocker(DockWidget):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("🍌 Nanobanana")
         self.setWidget(NanobananaChatWidget())
-    def canvasChanged(self, c): pass
+    def canvasChanged(self, c):
+        # Different document: the cached context can never match again
+        invalidate_context_cache()
 
+Krita.instance().notifier().applicationClosing.connect(_shutdown_pools)
 Krita.instance().addDockWidgetFactory(DockWidgetFactory("nanobanana", DockWidgetFactoryBase.DockRight, NanobananaDocker))
\ No newline at end of file
@@ -1,3 +1,4 @@
+import io
 import sys
 import types
 from unittest.mock import MagicMock
@@ -26,7 +27,8 @@ except ImportError:
     mock_core.Qt.AlignLeft = 1
     mock_core.QEvent = MagicMock
     mock_core.QEvent.KeyPress = 6
-    mock_core.QByteArray = MagicMock
+    mock_core.QByteArray = MagicMock()
+    mock_core.QRect = MagicMock
     mock_core.QSize = MagicMock
     mock_core.QObject = MagicMock # Added QObject
     
@@ -102,3 +104,37 @@ def mock_genai_client(mocker):
 def sample_image():
     """Creates a small dummy PIL image"""
     return Image.new('RGB', (100, 100), color='red')
+
+
+# --- Stream test data: mocks are built per test so side_effect/call_count never leak ---
+
+def _make_chunk(*parts):
+    """A stream chunk shaped like GenerateContentResponse: candidates[0].content.parts."""
+    chunk = MagicMock()
+    chunk.candidates = [MagicMock(content=MagicMock(parts=list(parts)))]
+    return chunk
+
+@pytest.fixture
+def make_chunk():
+    return _make_chunk
+
+@pytest.fixture(scope="session")
+def dummy_rgb():
+    """Small opaque image, built once per session; do not mutate (shared across tests)."""
+    return Image.new('RGB', (10, 10), color='red')
+
+@pytest.fixture
+def text_chunk():
+    part = MagicMock(text="Hello", inline_data=None)
+    part.thought = False
+    return _make_chunk(part)
+
+@pytest.fixture
+def image_chunk():
+    buf = io.BytesIO()
+    Image.new('RGB', (10, 10)).save(buf, format='PNG')
+    inline_data = MagicMock()
+    inline_data.data = buf.getvalue()
+    part = MagicMock(text=None, inline_data=inline_data)
+    part.thought = False
+    return _make_chunk(part)
@@ -1,39 +1,90 @@
 import pytest
 from unittest.mock import MagicMock, call, ANY
-from gemini_api import GeminiClient
-from google.genai import types
+from gemini_api import GeminiClient, MAX_HISTORY_TURNS, HISTORY_MAX_DIMENSION
+from google.genai import types, errors
 from PIL import Image
 import io
+import threading
 
 class TestGeminiClient:
     
     def test_init(self, mock_genai_client):
         client = GeminiClient("fake_key")
         mock_genai_client.assert_called_with(api_key="fake_key")
-        assert client.history == []
+        assert len(client.history) == 0
         assert client.system_instruction is not None
 
-    def test_image_to_part_success(self, mock_genai_client):
+    @pytest.mark.parametrize("mode, color", [('RGB', 'red'), ('L', 128), ('RGBA', (255, 0, 0, 255))])
+    def test_image_to_part_success(self, mock_genai_client, mode, color):
         client = GeminiClient("key")
-        img = Image.new('RGB', (10, 10), color='red')
+        img = Image.new(mode, (10, 10), color=color)
         
         part = client._image_to_part(img)
         
+        # Opaque images (incl. fully opaque RGBA) go out as JPEG
         assert isinstance(part, types.Part)
-        assert part.inline_data.mime_type == "image/png"
+        assert part.inline_data.mime_type == "image/jpeg"
         assert len(part.inline_data.data) > 0
         
-    def test_create_user_content(self, mock_genai_client):
+    def test_image_to_part_jpeg_quality(self, mock_genai_client):
+        img = Image.effect_noise((64, 64), 64).convert('RGB')
+        
+        low = GeminiClient("key", jpeg_quality=30)._image_to_part(img)
+        high = GeminiClient("key", jpeg_quality=95)._image_to_part(img)
+        
+        assert len(low.inline_data.data) < len(high.inline_data.data)
+        
+    def test_image_to_part_clamps_size(self, mock_genai_client):
+        client = GeminiClient("key", upload_max_dim=256)
+        
+        part = client._image_to_part(Image.new('RGB', (1024, 512), color='red'))
+        
+        decoded = Image.open(io.BytesIO(part.inline_data.data))
+        assert decoded.size == (256, 128)
+        
+    def test_image_to_part_transparent(self, mock_genai_client):
+        client = GeminiClient("key")
+        img = Image.new('RGBA', (10, 10), color=(255, 0, 0, 128))
+        
+        part = client._image_to_part(img)
+        
+        assert part.inline_data.mime_type in ("image/webp", "image/png")
+        decoded = Image.open(io.BytesIO(part.inline_data.data))
+        assert decoded.convert('RGBA').getpixel((0, 0))[3] == 128
+        
+    def test_image_to_part_cached_by_content(self, mock_genai_client, dummy_rgb):
         client = GeminiClient("key")
-        img = Image.new('RGB', (10, 10))
         
-        content = client._create_user_content("hello", [img])
+        part1 = client._image_to_part(dummy_rgb)
+        part2 = client._image_to_part(dummy_rgb.copy()) # equal pixels, different object
+        part3 = client._image_to_part(Image.new('RGB', (10, 10), color='blue'))
+        
+        assert part1 is part2
+        assert part3 is not part1
+        assert len(client._part_cache) == 2
+        
+    def test_image_to_part_reused_buffer(self, mock_genai_client):
+        client = GeminiClient("key")
+        # Large, noisy image first so the shared buffer holds a long stale tail
+        big = Image.effect_noise((256, 256), 64).convert('RGB')
+        client._image_to_part(big)
+        
+        part = client._image_to_part(Image.new('RGB', (8, 8), color='green'))
+        
+        decoded = Image.open(io.BytesIO(part.inline_data.data))
+        assert decoded.size == (8, 8)
+        assert len(part.inline_data.data) < 2048
+        
+    def test_create_user_content(self, mock_genai_client, dummy_rgb):
+        client = GeminiClient("key")
+        
+        content = client._create_user_content("hello", [dummy_rgb])
         
         assert content.role == "user"
         assert len(content.parts) == 2
         # First part: Image (Blob)
         assert content.parts[0].inline_data is not None
-        assert content.parts[0].inline_data.mime_type == "image/png"
+        assert content.parts[0].inline_data.mime_type == "image/jpeg"
         # Second part: Text
         assert content.parts[1].text == "hello"
 
@@ -47,50 +98,30 @@ class TestGeminiClient:
     def test_get_config(self, mock_genai_client):
         client = GeminiClient("key")
         
-        # Test with Aspect Ratio and Image Size
-        config = client._get_config(123, "16:9 (Landscape)", "2K")
+        config = client._get_config(123, "16:9")
         assert config.seed == 123
         assert config.response_modalities == ["TEXT", "IMAGE"]
         assert config.image_config.aspect_ratio == "16:9"
-        assert config.image_config.image_size == "2K"
         assert config.temperature == 1.0
         assert len(config.safety_settings) == 4
-        
-        # Test default Image Size
-        config_default = client._get_config(123, "1:1")
-        # 1K is default, so it might not be in the config if I filtered it out?
-        # My code: if image_size and image_size != "1K": img_config_args["image_size"] = image_size
-        # So it should NOT have image_size set
-        assert not hasattr(config_default.image_config, 'image_size') or config_default.image_config.image_size is None
 
         # Test without Aspect Ratio
         config_no_ar = client._get_config(456, None)
         assert config_no_ar.response_modalities == ["TEXT"]
         assert not hasattr(config_no_ar, 'image_config') or config_no_ar.image_config is None
 
-    def test_stream_handler_text_and_image(self, mock_genai_client):
+    @pytest.mark.parametrize("size, expected", [("2K", "2K"), ("1K", None)])
+    def test_get_config_image_size(self, mock_genai_client, size, expected):
         client = GeminiClient("key")
+        # 1K is the API default and is left out of the image config
+        config = client._get_config(123, "1:1", size)
+        assert config.image_config.image_size == expected
+
+    def test_stream_handler_text_and_image(self, mock_genai_client, text_chunk, image_chunk):
+        client = GeminiClient("key")
+        inline_data = image_chunk.candidates[0].content.parts[0].inline_data
         
-        # Mock response chunks
-        # Configure part to have thought=False explicitly
-        part1 = MagicMock(text="Hello", inline_data=None)
-        part1.thought = False
-        chunk1 = MagicMock()
-        chunk1.candidates = [MagicMock(content=MagicMock(parts=[part1]))]
-        
-        img_bytes = io.BytesIO()
-        Image.new('RGB', (10, 10)).save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        
-        chunk2 = MagicMock()
-        inline_data = MagicMock()
-        inline_data.data = img_bytes.read()
-        part2 = MagicMock(text=None, inline_data=inline_data)
-        part2.thought = False
-        chunk2.candidates = [MagicMock(content=MagicMock(parts=[part2]))]
-        
-        stream = [chunk1, chunk2]
-        results = list(client._stream_handler(stream))
+        results = list(client._stream_handler([text_chunk, image_chunk]))
         
         assert len(results) == 2
         # Check text
@@ -101,48 +132,21 @@ class TestGeminiClient:
         assert results[0][2].text == "Hello"
         assert results[1][2].inline_data == inline_data
 
-    # ... (other tests) ...
-
-    def test_send_prompt_success_updates_history(self, mock_genai_client):
+    def test_stream_handler_yields_text_per_part(self, mock_genai_client, make_chunk):
         client = GeminiClient("key")
-        mock_client_instance = mock_genai_client.return_value
-        
-        # Mock stream to yield text "World" using REAL types.Part to pass validation
-        # We need to mock the structure returned by generate_content_stream
-        # The stream returns GenerateContentResponse chunks.
-        
-        # Creating a real Part object requires importing types
-        from google.genai import types
-        real_part = types.Part(text="World")
-        
-        # We can still wrap it in a MagicMock structure for the chunk/candidate hierarchy
-        # BUT _stream_handler iterates through candidate.content.parts
-        chunk = MagicMock()
-        # We need to make sure the part we yield is compatible with what _stream_handler expects
-        # _stream_handler expects objects with .text, .inline_data, .thought attributes
-        # types.Part has these (thought might be missing on older SDK versions but we check getattr)
-        
-        # Let's mock the chunk structure but use a real Part for the inner data
-        chunk.candidates = [MagicMock(content=MagicMock(parts=[real_part]))]
-        
-        mock_client_instance.models.generate_content_stream.return_value = [chunk]
-
-        results = list(client.send_prompt("Hello", [], 123, "model", None))
+        stream = [make_chunk(types.Part(text=f"t{i} ")) for i in range(5)]
         
-        # Check yield
-        assert results[0][0] == "World"
-        
-        # Check History: User + Model
-        assert len(client.history) == 2
-        assert client.history[0].parts[0].text == "Hello"
-        assert client.history[1].parts[0].text == "World"
+        # No buffering here: a fragment is never held back waiting for the next part
+        results = list(client._stream_handler(stream))
+        assert [r[0] for r in results] == [f"t{i} " for i in range(5)]
+        assert all(r[2] is not None for r in results)
 
     def test_stream_handler_error_503(self, mock_genai_client):
         client = GeminiClient("key")
         
         def error_gen():
             yield MagicMock() # Setup ok
-            raise Exception("503 Service Unavailable: The model is overloaded.")
+            raise errors.ServerError(503, {"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}})
             
         results = list(client._stream_handler(error_gen()))
         
@@ -161,18 +165,25 @@ class TestGeminiClient:
         
         assert "Network Error" in results[0][0]
 
-    def test_send_prompt_success_updates_history(self, mock_genai_client):
+    def test_stream_handler_client_error(self, mock_genai_client):
+        client = GeminiClient("key")
+        
+        def error_gen():
+            raise errors.ClientError(400, {"error": {"code": 400, "message": "Invalid argument", "status": "INVALID_ARGUMENT"}})
+            yield MagicMock()
+            
+        results = list(client._stream_handler(error_gen()))
+        
+        assert "(400)" in results[0][0]
+        assert "Invalid argument" in results[0][0]
+
+    def test_send_prompt_success_updates_history(self, mock_genai_client, make_chunk):
         client = GeminiClient("key")
         mock_client_instance = mock_genai_client.return_value
         
         # Mock stream to yield text "World"
         # Use real types.Part to satisfy Pydantic validation in send_prompt
-        from google.genai import types
-        real_part = types.Part(text="World")
-        
-        chunk = MagicMock()
-        chunk.candidates = [MagicMock(content=MagicMock(parts=[real_part]))]
-        mock_client_instance.models.generate_content_stream.return_value = [chunk]
+        mock_client_instance.models.generate_content_stream.return_value = [make_chunk(types.Part(text="World"))]
 
         results = list(client.send_prompt("Hello", [], 123, "model", None))
         
@@ -184,6 +195,46 @@ class TestGeminiClient:
         assert client.history[0].parts[0].text == "Hello"
         assert client.history[1].parts[0].text == "World"
 
+    def test_send_prompt_history_stores_small_images(self, mock_genai_client, make_chunk):
+        client = GeminiClient("key")
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.models.generate_content_stream.return_value = [make_chunk(types.Part(text="Ok"))]
+        
+        big = Image.new('RGB', (1200, 600), color='red') # within the upload cap
+        list(client.send_prompt("Edit", [big], 123, "model", None))
+        
+        # The request itself carried the full image...
+        _, kwargs = mock_client_instance.models.generate_content_stream.call_args
+        sent = Image.open(io.BytesIO(kwargs['contents'][-1].parts[0].inline_data.data))
+        assert sent.size == (1200, 600)
+        
+        # ...but history keeps a downscaled copy
+        stored = Image.open(io.BytesIO(client.history[0].parts[0].inline_data.data))
+        assert max(stored.size) == HISTORY_MAX_DIMENSION
+        
+    def test_send_prompt_history_capped(self, mock_genai_client, make_chunk):
+        client = GeminiClient("key")
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.models.generate_content_stream.return_value = [make_chunk(types.Part(text="Ok"))]
+        
+        for i in range(MAX_HISTORY_TURNS + 2):
+            list(client.send_prompt(f"Turn {i}", [], 123, "model", None))
+        
+        assert len(client.history) == MAX_HISTORY_TURNS * 2
+        assert client.history[0].role == "user"
+        assert client.history[0].parts[0].text == "Turn 2"
+
+    def test_history_limit_keeps_pairs(self, mock_genai_client, make_chunk):
+        client = GeminiClient("key", history_limit=5) # rounded down to whole turns
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.models.generate_content_stream.return_value = [make_chunk(types.Part(text="Ok"))]
+        
+        for i in range(4):
+            list(client.send_prompt(f"Turn {i}", [], 123, "model", None))
+        
+        assert [c.role for c in client.history] == ["user", "model", "user", "model"]
+        assert client.history[0].parts[0].text == "Turn 2"
+
     def test_send_prompt_api_failure(self, mock_genai_client):
         client = GeminiClient("key")
         mock_client_instance = mock_genai_client.return_value
@@ -197,23 +248,113 @@ class TestGeminiClient:
 
     def test_generate_variation_no_history_update(self, mock_genai_client):
         client = GeminiClient("key")
-        client.history = [MagicMock()] # Existing history
+        client.history.append(types.Content(role="user", parts=[types.Part(text="Hi")])) # Existing history
         mock_client_instance = mock_genai_client.return_value
         mock_client_instance.models.generate_content_stream.return_value = []
+        mock_client_instance.caches.create.return_value.name = "cachedContents/history"
         
         list(client.generate_variation("Var", [], 123, "model", None))
+        list(client.generate_variation("Var", [], 456, "model", None))
         
         # History should remain same length
         assert len(client.history) == 1
         
-        # Call verification
+        # History is cached once and referenced by every variation
+        assert mock_client_instance.caches.create.call_count == 1
+        args, kwargs = mock_client_instance.models.generate_content_stream.call_args
+        # Request contents should be [UserNew] + cached ref
+        assert len(kwargs['contents']) == 1
+        assert kwargs['config'].cached_content == "cachedContents/history"
+        assert kwargs['config'].system_instruction is None
+
+    def test_generate_variation_cache_unavailable_sends_history(self, mock_genai_client):
+        client = GeminiClient("key")
+        client.history.append(types.Content(role="user", parts=[types.Part(text="Hi")]))
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.models.generate_content_stream.return_value = []
+        mock_client_instance.caches.create.side_effect = Exception("Connection reset")
+        
+        list(client.generate_variation("Var", [], 123, "model", None))
+        list(client.generate_variation("Var", [], 456, "model", None))
+        
+        # Failure remembered for this history: no retry per variation
+        assert mock_client_instance.caches.create.call_count == 1
         args, kwargs = mock_client_instance.models.generate_content_stream.call_args
         # Request contents should be [History, UserNew]
-        assert len(kwargs['contents']) == 2 
+        assert len(kwargs['contents']) == 2
+        assert kwargs['config'].cached_content is None
+        
+        # A transient failure is retried once the history changes
+        client._invalidate_history_cache()
+        list(client.generate_variation("Var", [], 789, "model", None))
+        assert mock_client_instance.caches.create.call_count == 2
+
+    @pytest.mark.parametrize("message, code, retried_after_growth", [
+        ("Cached content is too small. total_token_count=12, min_total_token_count=1024", 400, True),
+        ("Model gemini-2.5-flash-image is not supported for createCachedContent", 400, False),
+    ])
+    def test_history_cache_failure_memo(self, mock_genai_client, message, code, retried_after_growth):
+        client = GeminiClient("key")
+        client.history.extend([types.Content(role="user", parts=[types.Part(text="Hi")])] * 2)
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.caches.create.side_effect = errors.ClientError(
+            code, {"error": {"code": code, "message": message, "status": "INVALID_ARGUMENT"}})
+        
+        assert client._history_cache_name("model") is None
+        client._invalidate_history_cache() # e.g. undo + resend: same length, nothing new to try
+        assert client._history_cache_name("model") is None
+        assert mock_client_instance.caches.create.call_count == 1
+        
+        # Too small: tried again once the history has grown. Unsupported: never again.
+        client.history.extend([types.Content(role="user", parts=[types.Part(text="More")])] * 2)
+        client._invalidate_history_cache()
+        client._history_cache_name("model")
+        assert mock_client_instance.caches.create.call_count == (2 if retried_after_growth else 1)
+
+    def test_superseded_history_cache_deleted(self, mock_genai_client):
+        client = GeminiClient("key")
+        client.history.append(types.Content(role="user", parts=[types.Part(text="Hi")]))
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.caches.create.return_value.name = "cachedContents/old"
+        
+        assert client._history_cache_name("model") == "cachedContents/old"
+        client.reset_session()
+        # Deletion runs on a background thread so Reset never waits on the network
+        for t in threading.enumerate():
+            if t.name == "nanobanana-cache-delete": t.join()
+        mock_client_instance.caches.delete.assert_called_once_with(name="cachedContents/old")
+
+    def test_history_cache_dropped_if_history_changes_during_upload(self, mock_genai_client):
+        client = GeminiClient("key")
+        client.history.append(types.Content(role="user", parts=[types.Part(text="Hi")]))
+        mock_client_instance = mock_genai_client.return_value
+        
+        def create(**kwargs):
+            client.reset_session() # Reset pressed on the GUI thread mid-upload
+            return mock_client_instance.caches.create.return_value
+        mock_client_instance.caches.create.side_effect = create
+        
+        assert client._history_cache_name("model") is None
+        assert client._history_cache is None
+
+    def test_enhance_prompt_streams_concept(self, mock_genai_client):
+        client = GeminiClient("key")
+        mock_client_instance = mock_genai_client.return_value
+        mock_client_instance.models.generate_content_stream.return_value = [
+            MagicMock(text='{"concept": "A \\"blue\\" c'),
+            MagicMock(text='at", "final_'),
+            MagicMock(text='prompt": "A blue cat"}'),
+        ]
+        concepts = []
+        
+        result = client.enhance_prompt("cat", [], on_concept=concepts.append)
+        
+        assert result == {"concept": 'A "blue" cat', "final_prompt": "A blue cat"}
+        assert concepts == ['A "blue" cat']
 
     def test_undo(self, mock_genai_client):
         client = GeminiClient("key")
-        client.history = [1, 2, 3, 4] 
+        client.history.extend([1, 2, 3, 4])
         
         assert client.undo_last_turn() is True
         assert len(client.history) == 2
@@ -223,8 +364,10 @@ class TestGeminiClient:
         
         assert client.undo_last_turn() is False
 
-    def test_reset_session(self, mock_genai_client):
+    def test_reset_session(self, mock_genai_client, dummy_rgb):
         client = GeminiClient("key")
-        client.history = [1, 2]
+        client.history.extend([1, 2])
+        client._image_to_part(dummy_rgb)
         client.reset_session()
-        assert len(client.history) == 0
\ No newline at end of file
+        assert len(client.history) == 0
+        assert len(client._part_cache) == 0
\ No newline at end of file
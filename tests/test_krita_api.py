@@ -1,11 +1,32 @@
-from krita_api import resize_image_maintain_aspect, get_smart_context, update_preview_layer, get_nearest_supported_ar
+from krita_api import resize_image_maintain_aspect, get_smart_context, update_preview_layer, get_nearest_supported_ar, _bgra_to_pil, _is_buffer_empty, CanvasCapture, process_capture, invalidate_context_cache
+import krita_api
 from PIL import Image
 import numpy as np
 
 # Implicitly uses mocked krita from conftest
 import krita 
+import pytest
 from unittest.mock import MagicMock
 
+# Only the Krita API surface krita_api actually touches: typos/new calls fail loudly
+DOC_API = ["width", "height", "selection", "pixelData", "nodeByName", "rootNode",
+           "createNode", "setActiveNode", "refreshProjection"]
+SEL_API = ["x", "y", "width", "height"]
+NODE_API = ["visible", "setVisible", "bounds", "setPixelData", "setOpacity"]
+
+@pytest.fixture(autouse=True)
+def reset_krita():
+    """The krita mock is module-global: drop recorded calls and per-test return values."""
+    yield
+    krita.Krita.reset_mock(return_value=True, side_effect=True)
+
+@pytest.fixture(autouse=True)
+def reset_context_cache():
+    """The processed-context cache is module-global too: every test starts cold."""
+    invalidate_context_cache()
+    yield
+    invalidate_context_cache()
+
 class TestKritaApi:
     
     def test_resize_logic(self):
@@ -13,6 +34,47 @@ class TestKritaApi:
         resized = resize_image_maintain_aspect(img, max_dim=1000)
         assert resized.size == (1000, 500)
         
+        # Large shrink goes through the integer reduce step first
+        img = Image.new('RGB', (4096, 2048))
+        resized = resize_image_maintain_aspect(img, max_dim=1536)
+        assert resized.size == (1536, 768)
+        
+    def test_resize_large_opaque_uses_cv2(self, mocker):
+        pytest.importorskip("cv2")
+        spy = mocker.spy(krita_api.cv2, "resize")
+        resized = resize_image_maintain_aspect(Image.new('RGBA', (2048, 1024), (255, 0, 0, 255)))
+        assert resized.size == (1536, 768)
+        assert resized.mode == 'RGBA'
+        assert spy.call_count == 1
+        
+    def test_bgra_to_pil_channel_order(self):
+        # Krita BGRA: B=10, G=20, R=30, A=40
+        img = _bgra_to_pil(bytes([10, 20, 30, 40]) * 6, 3, 2)
+        assert img.mode == 'RGBA'
+        assert img.size == (3, 2)
+        assert img.getpixel((2, 1)) == (30, 20, 10, 40)
+
+    def test_is_buffer_empty(self):
+        # Raw Krita BGRA bytes, checked without a PIL conversion
+        assert _is_buffer_empty(bytes(64 * 64 * 4), 64, 64) is True # transparent
+        assert _is_buffer_empty(b'\xff' * (64 * 64 * 4), 64, 64) is True # opaque white
+        assert _is_buffer_empty(bytes([0, 0, 255, 255]) * (64 * 64), 64, 64) is False # opaque red
+        white = bytearray(b'\xff' * (64 * 64 * 4))
+        white[(17 * 64 + 33) * 4:(17 * 64 + 33) * 4 + 3] = bytes(3) # one black pixel
+        assert _is_buffer_empty(bytes(white), 64, 64) is False
+        
+    def test_is_buffer_empty_single_pixel(self):
+        # One opaque pixel off the sample grid of a large transparent canvas:
+        # the sparse sample misses it, the full fallback scan must not
+        w = h = 1024
+        data = bytearray(w * h * 4)
+        offset = (517 * w + 301) * 4
+        data[offset:offset + 4] = bytes([0, 0, 255, 255])
+        assert _is_buffer_empty(bytes(data), w, h) is False
+        
+    def test_bgra_to_pil_size_mismatch(self):
+        assert _bgra_to_pil(bytes(10), 3, 2) is None
+
     def test_ar_calculation(self):
         assert get_nearest_supported_ar(100, 100) == "1:1"
         assert get_nearest_supported_ar(1600, 900) == "16:9"
@@ -29,11 +91,11 @@ class TestKritaApi:
         assert geom == (0,0,0,0)
 
     def test_smart_context_selection_priority_with_content(self):
-        mock_doc = MagicMock()
+        mock_doc = MagicMock(spec_set=DOC_API)
         mock_doc.width.return_value = 1000
         mock_doc.height.return_value = 1000
         
-        mock_sel = MagicMock()
+        mock_sel = MagicMock(spec_set=SEL_API)
         mock_sel.x.return_value = 10
         mock_sel.y.return_value = 10
         mock_sel.width.return_value = 100
@@ -43,8 +105,8 @@ class TestKritaApi:
         # Create Non-Empty Data (Grey, fully opaque)
         # BGRA: 100, 100, 100, 255
         pixel_count = 100 * 100
-        # Create a pattern that isn't just zeros
-        fake_data = bytes([100, 100, 100, 255] * pixel_count)
+        # Create a pattern that isn't just zeros (bytes repetition runs in C, no int list)
+        fake_data = bytes([100, 100, 100, 255]) * pixel_count
         
         mock_doc.pixelData.return_value = fake_data
         
@@ -57,9 +119,27 @@ class TestKritaApi:
         assert geom == (10, 10, 100, 100)
         assert len(imgs) == 1
 
+    def test_smart_context_preview_outside_region_skips_refresh(self):
+        mock_doc = MagicMock(spec_set=DOC_API)
+        mock_doc.selection.return_value = None
+        mock_doc.width.return_value = 10
+        mock_doc.height.return_value = 10
+        mock_doc.pixelData.return_value = bytes(10 * 10 * 4)
+        
+        preview = MagicMock(spec_set=NODE_API)
+        preview.visible.return_value = True
+        preview.bounds.return_value.intersects.return_value = False
+        mock_doc.nodeByName.return_value = preview
+        krita.Krita.instance.return_value.activeDocument.return_value = mock_doc
+        
+        get_smart_context()
+        
+        preview.setVisible.assert_not_called()
+        mock_doc.refreshProjection.assert_not_called()
+
     def test_smart_context_full_canvas_empty(self):
         """Test that empty canvas triggers Txt2Img mode (empty images list)"""
-        mock_doc = MagicMock()
+        mock_doc = MagicMock(spec_set=DOC_API)
         mock_doc.width.return_value = 200
         mock_doc.height.return_value = 200
         mock_doc.selection.return_value = None 
@@ -71,7 +151,7 @@ class TestKritaApi:
         krita.Krita.instance.return_value.activeWindow.return_value = mock_win
         
         # Empty (Transparent)
-        fake_data = bytes([0] * (200 * 200 * 4))
+        fake_data = bytes(200 * 200 * 4)
         mock_doc.pixelData.return_value = fake_data
         
         krita.Krita.instance.return_value.activeDocument.return_value = mock_doc
@@ -83,13 +163,57 @@ class TestKritaApi:
         assert geom == (0, 0, 200, 200)
         assert len(imgs) == 0 # Should be empty for Smart Txt2Img
 
+    def test_process_capture_multi_layer(self):
+        opaque = bytes([0, 0, 255, 255]) * (20 * 10)
+        empty = bytes(30 * 30 * 4)
+        capture = CanvasCapture([(opaque, 20, 10), (empty, 30, 30)], (0, 0, 500, 500), "Layers (Smart)", "1:1", multi_layer=True)
+        
+        imgs, desc = process_capture(capture)
+        
+        assert len(imgs) == 1 # Empty layer skipped
+        assert imgs[0].size == (20, 10)
+        assert desc == "1 Layers (Smart)"
+
+    def test_process_capture_large_layers_use_given_pool(self):
+        layer = (bytes([0, 0, 255, 255]) * (1024 * 512), 1024, 512)
+        capture = CanvasCapture([layer, layer], (0, 0, 1024, 512), "Layers (Smart)", "2:1", multi_layer=True)
+        pool = MagicMock()
+        pool.map.side_effect = map # run inline, in order
+        
+        imgs, _ = process_capture(capture, pool)
+        
+        assert pool.map.call_count == 1
+        assert len(imgs) == 2
+
+    def test_process_capture_cached_until_pixels_change(self, mocker):
+        spy = mocker.spy(krita_api, "_convert_capture")
+        data = bytearray([0, 0, 255, 255]) * (8 * 8)
+        capture = CanvasCapture([(bytes(data), 8, 8)], (0, 0, 8, 8), "Canvas", "1:1")
+        
+        first = process_capture(capture)
+        assert process_capture(capture) == first
+        assert spy.call_count == 1
+        
+        # An equal grab (new buffer, same pixels) is still a hit
+        process_capture(CanvasCapture([(bytes(data), 8, 8)], (0, 0, 8, 8), "Canvas", "1:1"))
+        assert spy.call_count == 1
+        
+        # A stroke changes the grabbed pixels (here the very last byte) -> recompute
+        data[-1] = 1
+        process_capture(CanvasCapture([(bytes(data), 8, 8)], (0, 0, 8, 8), "Canvas", "1:1"))
+        assert spy.call_count == 2
+        
+        invalidate_context_cache()
+        process_capture(capture)
+        assert spy.call_count == 3
+
     def test_update_preview_layer(self):
-        mock_doc = MagicMock()
+        mock_doc = MagicMock(spec_set=DOC_API)
         mock_root = MagicMock()
         mock_doc.rootNode.return_value = mock_root
         mock_doc.nodeByName.return_value = None 
         
-        mock_node = MagicMock()
+        mock_node = MagicMock(spec_set=NODE_API)
         mock_doc.createNode.return_value = mock_node
         
         krita.Krita.instance.return_value.activeDocument.return_value = mock_doc
@@ -107,4 +231,36 @@ class TestKritaApi:
         assert args[1] == 0 # x
         assert args[2] == 0 # y
         assert args[3] == 100 # w
-        assert args[4] == 100 # h
\ No newline at end of file
+        assert args[4] == 100 # h
+
+    def test_update_preview_layer_bgra_order(self, mocker):
+        mocker.patch('krita_api.QByteArray').fromRawData.side_effect = lambda data: data
+        mock_doc = MagicMock(spec_set=DOC_API)
+        mock_node = MagicMock(spec_set=NODE_API)
+        mock_doc.nodeByName.return_value = mock_node
+        krita.Krita.instance.return_value.activeDocument.return_value = mock_doc
+        
+        # RGBA (R=10, G=20, B=30, A=40) -> Krita BGRA
+        img = Image.new('RGBA', (4, 2), color=(10, 20, 30, 40))
+        assert update_preview_layer(img, x=5, y=6) is True
+        
+        args, _ = mock_node.setPixelData.call_args
+        assert args[0] == bytes([30, 20, 10, 40]) * 8
+        assert args[1:] == (5, 6, 4, 2)
+
+    @pytest.mark.parametrize("color, uses_cv2", [((10, 20, 30, 255), True), ((10, 20, 30, 40), False)])
+    def test_update_preview_layer_resize_path(self, mocker, color, uses_cv2):
+        pytest.importorskip("cv2")
+        mocker.patch('krita_api.QByteArray').fromRawData.side_effect = lambda data: data
+        spy = mocker.spy(krita_api.cv2, "resize")
+        mock_doc = MagicMock(spec_set=DOC_API)
+        mock_node = MagicMock(spec_set=NODE_API)
+        mock_doc.nodeByName.return_value = mock_node
+        krita.Krita.instance.return_value.activeDocument.return_value = mock_doc
+        
+        # Translucent pixels must not go through cv2 (straight alpha would bleed)
+        assert update_preview_layer(Image.new('RGBA', (4, 2), color), 0, 0, 8, 4) is True
+        assert (spy.call_count == 1) == uses_cv2
+        args, _ = mock_node.setPixelData.call_args
+        assert args[0][3::4] == bytes([color[3]]) * 32 # BGRA, alpha intact
+        assert args[3:] == (8, 4)
@@ -0,0 +1,119 @@
+import importlib
+import pathlib
+import sys
+from collections import deque
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+# nanobanana.py uses package-relative imports, so load it through the plugin package
+_PLUGIN_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(_PLUGIN_DIR.parent) not in sys.path:
+    sys.path.insert(0, str(_PLUGIN_DIR.parent))
+nanobanana = importlib.import_module(f"{_PLUGIN_DIR.name}.nanobanana")
+Widget = nanobanana.NanobananaChatWidget
+
+def _widget(**state):
+    """Bare stand-in carrying only the state the method under test touches."""
+    w = SimpleNamespace(**state)
+    w._flush_text = lambda: Widget._flush_text(w)
+    w._schedule_scroll = MagicMock()
+    return w
+
+class _FakeBubble:
+    def __init__(self, role, text):
+        self.role, self.text, self.images = role, text, []
+    def record(self):
+        return (self.role, self.text, list(self.images))
+    def add_image(self, thumb, seed):
+        self.images.append((thumb, seed))
+    def deleteLater(self):
+        pass
+
+class _ListLayout:
+    """List-backed stand-in for the chat QVBoxLayout; index 0 is the stretch."""
+    def __init__(self):
+        self.items = [None]
+    def count(self):
+        return len(self.items)
+    def addWidget(self, w):
+        self.items.append(w)
+    def insertWidget(self, i, w):
+        self.items.insert(i, w)
+    def takeAt(self, i):
+        return MagicMock(widget=MagicMock(return_value=self.items.pop(i)))
+
+class TestChatWidget:
+
+    def test_streamed_text_coalesced_into_one_flush(self, mocker):
+        timer = mocker.patch.object(nanobanana, "QTimer")
+        bubble = MagicMock()
+        w = _widget(current_ai_bubble=bubble, _text_pending=[])
+
+        for i in range(100):
+            Widget.handle_text(w, f"t{i} ")
+
+        # One timer for the whole burst; its flush draws everything at once
+        assert timer.singleShot.call_count == 1
+        delay, flush = timer.singleShot.call_args[0]
+        assert delay == nanobanana.TEXT_FLUSH_MS
+        flush()
+        bubble.append_text.assert_called_once_with("".join(f"t{i} " for i in range(100)))
+        assert w._text_pending == []
+
+    def _sent(self, history, recorded):
+        """Widget state right after a send finished, with or without a new history turn."""
+        client = MagicMock(history=history)
+        w = _widget(client=client, _user_prompts=[], _failed_prompt=None, _in_flight=("Cat", history[-1] if history else None))
+        if recorded:
+            history.extend(["user", "model"])
+        Widget._record_turn(w)
+        w.remove_last_interaction = MagicMock()
+        w.add_message = MagicMock()
+        w.inp = MagicMock()
+        w.start_gen = MagicMock()
+        return w
+
+    def test_prompt_pushed_only_for_recorded_turn(self):
+        assert self._sent(deque(), recorded=True)._user_prompts == ["Cat"]
+        
+        failed = self._sent(deque(["u0", "m0"]), recorded=False)
+        assert failed._user_prompts == []
+        assert failed._failed_prompt == "Cat"
+
+    def test_retry_after_failed_send_keeps_history(self):
+        history = deque(["u0", "m0"])
+        w = self._sent(history, recorded=False)
+        Widget.retry_last(w)
+        
+        w.client.undo_last_turn.assert_not_called()
+        assert list(history) == ["u0", "m0"] # earlier turn untouched
+        w.inp.setText.assert_called_once_with("Cat")
+
+    def test_retry_pops_only_when_undo_succeeds(self):
+        w = self._sent(deque(), recorded=True)
+        w.client.undo_last_turn.return_value = False # e.g. history already trimmed
+        Widget.retry_last(w)
+        
+        assert w._user_prompts == ["Cat"]
+        w.start_gen.assert_not_called()
+
+    def test_bubbles_beyond_cap_kept_as_records_and_restored(self, monkeypatch):
+        monkeypatch.setattr(nanobanana, "MAX_CHAT_BUBBLES", 3)
+        monkeypatch.setattr(nanobanana, "OLDER_PAGE", 2)
+        layout = _ListLayout()
+        w = _widget(chat_layout=layout, _older_records=[], btn_older=MagicMock(), scroll_content=MagicMock())
+        w._make_bubble = lambda role, text: _FakeBubble(role, text)
+        w._update_older_button = lambda: Widget._update_older_button(w)
+
+        for i in range(6):
+            Widget.add_message(w, "user", f"m{i}")
+
+        # Widgets stay bounded; nothing is lost and the user can see it
+        assert [b.text for b in layout.items[1:]] == ["m3", "m4", "m5"]
+        assert [rec[1] for rec in w._older_records] == ["m0", "m1", "m2"]
+        w.btn_older.setText.assert_called_with("▲ 3 older messages hidden (show more)")
+        w.btn_older.setVisible.assert_called_with(True)
+
+        Widget.show_older_messages(w)
+        assert [b.text for b in layout.items[1:]] == ["m1", "m2", "m3", "m4", "m5"]
+        assert [rec[1] for rec in w._older_records] == ["m0"]
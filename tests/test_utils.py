@@ -1,12 +1,18 @@
 import pytest
 from utils import NanobananaSettings
+import utils
 import json
+import gc
+import weakref
+
+@pytest.fixture(autouse=True)
+def _patch_qstd(tmp_path, monkeypatch):
+    """Every settings instance in this module writes under the test's tmp_path."""
+    monkeypatch.setattr('PyQt5.QtCore.QStandardPaths.writableLocation', lambda *_: str(tmp_path))
 
 class TestNanobananaSettings:
     
-    def test_load_save_settings(self, tmp_path, mocker):
-        mocker.patch('PyQt5.QtCore.QStandardPaths.writableLocation', return_value=str(tmp_path))
-        
+    def test_load_save_settings(self, tmp_path):
         settings = NanobananaSettings()
         
         # Check defaults
@@ -16,6 +22,9 @@ class TestNanobananaSettings:
         settings.set("batch_size", 4)
         settings.set("aspect_ratio", "16:9")
         
+        # Writes are debounced; flush as the timer would
+        settings._flush()
+        
         # Verify file on disk
         expected_file = tmp_path / "nanobanana" / "settings.json"
         assert expected_file.exists()
@@ -25,9 +34,33 @@ class TestNanobananaSettings:
             assert data["batch_size"] == 4
             assert data["aspect_ratio"] == "16:9"
             
-    def test_invalid_json_handling(self, tmp_path, mocker):
-        mocker.patch('PyQt5.QtCore.QStandardPaths.writableLocation', return_value=str(tmp_path))
+    def test_save_is_atomic_and_skips_unchanged(self, tmp_path, mocker):
+        settings = NanobananaSettings()
+        settings.set("batch_size", 2)
+        settings._flush()
+        
+        replace = mocker.spy(utils.os, "replace")
+        settings.set("batch_size", 2) # same value
+        settings._flush()
+        assert replace.call_count == 0
         
+        settings.set("batch_size", 3)
+        settings._flush()
+        assert replace.call_count == 1
+        assert not (tmp_path / "nanobanana" / "settings.json.tmp").exists()
+
+    def test_pending_write_flushed_at_exit_without_pinning(self, tmp_path):
+        settings = NanobananaSettings()
+        settings.set("batch_size", 5)
+        utils._flush_all() # what the exit hook runs
+        assert json.loads((tmp_path / "nanobanana" / "settings.json").read_text())["batch_size"] == 5
+        
+        ref = weakref.ref(settings)
+        del settings
+        gc.collect()
+        assert ref() is None # the exit hook holds no strong reference
+            
+    def test_invalid_json_handling(self, tmp_path):
         settings_dir = tmp_path / "nanobanana"
         settings_dir.mkdir()
         settings_file = settings_dir / "settings.json"
@@ -39,15 +72,13 @@ class TestNanobananaSettings:
         
         assert settings.get("model") == "gemini-2.5-flash-image"
         
-    def test_set_invalid_key_type(self, tmp_path, mocker):
-        mocker.patch('PyQt5.QtCore.QStandardPaths.writableLocation', return_value=str(tmp_path))
+    def test_set_invalid_key_type(self):
         settings = NanobananaSettings()
         
         with pytest.raises(ValueError):
             settings.set(123, "value")
             
-    def test_set_non_serializable_value(self, tmp_path, mocker):
-        mocker.patch('PyQt5.QtCore.QStandardPaths.writableLocation', return_value=str(tmp_path))
+    def test_set_non_serializable_value(self):
         settings = NanobananaSettings()
         
         class Unserializable: pass
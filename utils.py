@@ -1,12 +1,42 @@
 import os
 # [AI-CHANGE] Import pathlib for modern path handling to improve cross-platform compatibility and readability.
 import pathlib
+import atexit
 import json
 import logging
-from PyQt5.QtCore import QStandardPaths
+import weakref
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+def _dumps(data) -> bytes:
+    """Settings JSON as UTF-8 bytes (orjson if available, same 2-space layout otherwise)."""
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+def _loads(raw: bytes):
+    return orjson.loads(raw) if HAS_ORJSON else json.loads(raw.decode('utf-8'))
+
+# set() calls within this window collapse into a single disk write
+SAVE_DEBOUNCE_MS = 250
+
+# Live settings objects; one exit hook flushes them all without keeping any alive
+_instances: "weakref.WeakSet[NanobananaSettings]" = weakref.WeakSet()
+
+@atexit.register
+def _flush_all() -> None:
+    """Don't lose a pending debounced write on shutdown."""
+    for settings in list(_instances):
+        settings._flush()
 
 class NanobananaSettings:
     def __init__(self):
+        # Qt is only needed once a settings object is built; keeps `import utils` light
+        from PyQt5.QtCore import QStandardPaths, QTimer
         app_data = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
         # [AI-FIX: Use pathlib.Path for better path manipulation and to avoid os.path issues.]
         self.settings_dir = pathlib.Path(app_data) / "nanobanana"
@@ -28,7 +58,16 @@ class NanobananaSettings:
             encoding='utf-8'
         )
         
+        self._last_written = b"" # bytes currently on disk, to skip no-op saves
         self.load_settings()
+        
+        # Debounced writer: a burst of set() calls (e.g. slider ticks) saves once
+        self._dirty = False
+        self._save_timer = QTimer()
+        self._save_timer.setSingleShot(True)
+        self._save_timer.setInterval(SAVE_DEBOUNCE_MS)
+        self._save_timer.timeout.connect(self._flush)
+        _instances.add(self)
 
     def load_settings(self):
         """Загрузка настроек из файла"""
@@ -39,15 +78,16 @@ class NanobananaSettings:
         
         try:
             if self.settings_file.exists():  # [AI-FIX: Use pathlib exists() method for consistency.]
-                with open(self.settings_file, 'r', encoding='utf-8') as f:
-                    loaded = json.load(f)
-                    self.settings = {**default, **loaded}
+                raw = self.settings_file.read_bytes()
+                loaded = _loads(raw)
+                self.settings = {**default, **loaded}
+                self._last_written = raw
                 logging.info("Settings loaded successfully")
             else:
                 self.settings = default
                 self.save_settings()
                 logging.info("Default settings created")
-        except json.JSONDecodeError as e:  # [AI-FIX: Catch specific JSON errors for better error handling.]
+        except ValueError as e:  # JSONDecodeError from json or orjson (both subclass ValueError)
             logging.error(f"Invalid JSON in settings file: {e}")
             self.settings = default
         except OSError as e:  # [AI-FIX: Catch file system errors separately.]
@@ -60,8 +100,15 @@ class NanobananaSettings:
     def save_settings(self):
         """Сохранение настроек в файл"""
         try:
-            with open(self.settings_file, 'w', encoding='utf-8') as f:
-                json.dump(self.settings, f, indent=2, ensure_ascii=False)
+            payload = _dumps(self.settings)
+            if payload == self._last_written:
+                return True # Nothing changed on disk
+            
+            # Write aside, then swap in: a crash mid-write never leaves a truncated file
+            tmp = self.settings_file.with_suffix('.json.tmp')
+            tmp.write_bytes(payload)
+            os.replace(tmp, self.settings_file)
+            self._last_written = payload
             logging.info("Settings saved successfully")
             return True
         except OSError as e:  # [AI-FIX: Catch specific file system errors.]
@@ -85,4 +132,12 @@ class NanobananaSettings:
         except (TypeError, ValueError) as e:
             raise ValueError(f"Value is not JSON serializable: {e}")
         self.settings[key] = value
+        self._dirty = True
+        self._save_timer.start() # restarts the debounce window
+        return True
+
+    def _flush(self):
+        """Writes pending changes now (timer callback; also called at exit)."""
+        if not self._dirty: return True
+        self._dirty = False
         return self.save_settings()
\ No newline at end of file